@@ -0,0 +1,263 @@
+"""Handler throughput benchmark
+
+Drives the real handlers in main.py with synthetic updates through the configured update
+processor (PerUserUpdateProcessor: per-user locks and the MAX_CONCURRENT_UPDATES limit), the
+way PTB's update fetcher does. Only the hop through the bounded update_queue is skipped. A
+recording fake Bot API stands in for Telegram, and mongomock (or a local mongod via
+--mongo-uri) stands in for Atlas.
+
+    python bench.py                       # all flows, in-memory store
+    python bench.py --flows mmb balance --users 50 --iterations 20
+    python bench.py --mongo-uri mongodb://localhost:27017/ --compare bench_results/<previous>.json
+
+Prints ops/sec and p50/p99 per flow, and saves the results to bench_results/ for comparison.
+"""
+import argparse, asyncio, itertools, json, os, subprocess, sys, time
+from datetime import datetime
+
+# Bench defaults; must be in place before main/env are imported
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("ADMIN_GROUP_ID", "-1001")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from telegram import Update
+from telegram.request import BaseRequest
+from replay import fake_api_result, fake_message, message_ids
+
+ADMIN_ID = int(os.environ["ADMIN_ID"])
+FLOWS = ("mmb", "balance", "topup", "topup_approve")
+RESULTS_DIR = "bench_results"
+
+update_ids = itertools.count(1)
+
+class RecordingRequest(BaseRequest):
+    """In-process Bot API: records every call and answers from fake_api_result"""
+
+    def __init__(self):
+        self.calls = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        """Nothing to open"""
+
+    async def shutdown(self):
+        """Nothing to close"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": fake_api_result(api_method, params)}).encode()
+
+def user_dict(user_id):
+    """Bot API User object for a synthetic user"""
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+def command_update(bot, user_id, text):
+    """Synthetic private-chat command message"""
+    command = text.split()[0]
+    return Update.de_json({
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": user_dict(user_id),
+            "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        }
+    }, bot)
+
+def photo_update(bot, user_id):
+    """Synthetic private-chat photo message (payment screenshot)"""
+    return Update.de_json({
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": user_dict(user_id),
+            "photo": [{"file_id": f"photo{user_id}", "file_unique_id": f"photo{user_id}", "width": 90, "height": 90}]
+        }
+    }, bot)
+
+def callback_update(bot, user_id, data, text="bench"):
+    """Synthetic inline button press"""
+    return Update.de_json({
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)), "from": user_dict(user_id), "chat_instance": "bench", "data": data,
+            "message": fake_message(user_id, text)
+        }
+    }, bot)
+
+async def process(app, update):
+    """Process an update under the app's update processor, as the update fetcher would"""
+    await app.update_processor.process_update(update, app.process_update(update))
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def seed(main, user_ids):
+    """Authorize the bench users and give them enough balance for every order"""
+    await main.save_settings_field("authorized_users", list(user_ids))
+    await main.save_settings_field("admin_ids", [ADMIN_ID])
+    await main.load_authorized_users()
+    for user_id in user_ids:
+        await main.create_user(user_id, f"User{user_id}", f"user{user_id}")
+    await main.run_db(
+        main.users_collection.update_many, {"user_id": {"$in": [str(uid) for uid in user_ids]}},
+        {"$set": {"balance": 10 ** 12}}
+    )
+
+async def prepare_flow(main, app, flow, user_id):
+    """Untimed setup for one iteration of a flow; returns the updates to time"""
+    bot = app.bot
+    if flow == "mmb":
+        return [command_update(bot, user_id, "/mmb 12345678 1234 86")]
+    if flow == "balance":
+        return [command_update(bot, user_id, "/balance")]
+    if flow == "topup":
+        return [
+            command_update(bot, user_id, "/topup 5000"),
+            callback_update(bot, user_id, "topup_pay_kpay_5000"),
+            photo_update(bot, user_id)
+        ]
+    # topup_approve: the admin approves a pending topup this user has just submitted
+    for update in await prepare_flow(main, app, "topup", user_id):
+        await process(app, update)
+    topup = await main.run_db(
+        main.topups_collection.find_one, {"user_id": str(user_id), "status": "pending"},
+        sort=[("created_at", -1)]
+    )
+    return [callback_update(bot, ADMIN_ID, f"topup_approve_{topup['topup_id']}")]
+
+async def release_flow(main, app, flow, user_id):
+    """Untimed cleanup so the user can run the flow again"""
+    if flow == "topup":
+        await process(app, command_update(app.bot, ADMIN_ID, f"/approve {user_id} 5000"))
+
+async def bench_flow(main, app, flow, user_ids, iterations):
+    """Run a flow concurrently for every user, one round per iteration; returns its result summary"""
+    latencies = []
+    timed_seconds = 0.0
+
+    async def timed_updates(updates):
+        started = time.perf_counter()
+        for update in updates:
+            await process(app, update)
+        latencies.append(time.perf_counter() - started)
+
+    for _ in range(iterations):
+        prepared = await asyncio.gather(*(prepare_flow(main, app, flow, user_id) for user_id in user_ids))
+        started = time.perf_counter()
+        await asyncio.gather(*(timed_updates(updates) for updates in prepared))
+        timed_seconds += time.perf_counter() - started
+        await asyncio.gather(*(release_flow(main, app, flow, user_id) for user_id in user_ids))
+
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / timed_seconds,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+def git_revision():
+    """Short git revision of the benchmarked tree, or 'unknown'"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def print_results(results, baseline=None):
+    """Print the per-flow table, with the change against a baseline run when given"""
+    print(f"Updates run through {results['update_processor']} (update_queue hop not included)")
+    print(f"{'flow':<15}{'ops':>8}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for flow, result in results["flows"].items():
+        line = f"{flow:<15}{result['ops']:>8}{result['ops_per_sec']:>12.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+        previous = (baseline or {}).get("flows", {}).get(flow)
+        if previous:
+            change = (result["ops_per_sec"] / previous["ops_per_sec"] - 1) * 100
+            line += f"   {change:+.1f}% ops/sec vs {baseline['revision']}"
+        print(line)
+
+async def run(args):
+    """Set up the store, app and users, then run each flow"""
+    if not args.mongo_uri:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is not installed; pip install mongomock or pass --mongo-uri for a local mongod")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        # mongomock is not thread-safe, keep pymongo calls on one executor thread
+        os.environ["DB_POOL_SIZE"] = "1"
+    os.environ["MONGO_URI"] = args.mongo_uri or "mongodb://localhost:27017/"
+
+    import main
+    if not args.send_limits:
+        # The fake Bot API never rate limits, so by default measure the bot's own cost, not Telegram pacing
+        main.TELEGRAM_CHAT_RATE = main.TELEGRAM_GROUP_RATE = main.TELEGRAM_GLOBAL_RATE = 1e9
+        main.global_send_bucket = main.TokenBucket(1e9, 1e9)
+
+    request = RecordingRequest()
+    app = main.build_application(request=request)
+    # warm_caches also creates the settings document seed() writes to
+    await asyncio.gather(app.initialize(), main.warm_caches())
+    await app.start()
+    await main.run_db(main.ensure_indexes)
+    main.start_order_workers(app.bot)
+
+    user_ids = [100000 + i for i in range(args.users)]
+    await seed(main, user_ids)
+
+    results = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "store": "mongod" if args.mongo_uri else "mongomock",
+        "send_limits": args.send_limits,
+        "update_processor": f"{type(app.update_processor).__name__}({app.update_processor.handler_limit})",
+        "users": args.users,
+        "iterations": args.iterations,
+        "flows": {}
+    }
+    try:
+        for flow in args.flows:
+            results["flows"][flow] = await bench_flow(main, app, flow, user_ids, args.iterations)
+    finally:
+        await main.stop_order_workers()
+        await app.stop()
+        await app.shutdown()
+    results["bot_api_calls"] = request.calls
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler throughput with a fake Bot API")
+    parser.add_argument("--flows", nargs="+", choices=FLOWS, default=list(FLOWS))
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=10, help="flow iterations per user")
+    parser.add_argument("--mongo-uri", help="scratch local mongod to use instead of mongomock (bench users are written to it)")
+    parser.add_argument("--send-limits", action="store_true", help="keep the Telegram send pacing (30/s, 1/s per chat)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true", help="don't write a results file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{results['timestamp'].replace(':', '')}-{results['revision']}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,29 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID_STR = os.environ.get("ADMIN_ID")
 ADMIN_GROUP_ID_STR = os.environ.get("ADMIN_GROUP_ID")
 MONGO_URI = os.environ.get("MONGO_URI")
+DB_POOL_SIZE_STR = os.environ.get("DB_POOL_SIZE", "16")
+SETTINGS_CACHE_TTL_STR = os.environ.get("SETTINGS_CACHE_TTL", "30")
+MAX_CONCURRENT_UPDATES_STR = os.environ.get("MAX_CONCURRENT_UPDATES", "64")
+UPDATE_QUEUE_SIZE_STR = os.environ.get("UPDATE_QUEUE_SIZE", "1000")
+ORDER_WORKERS_STR = os.environ.get("ORDER_WORKERS", "4")
+ORDER_QUEUE_SIZE_STR = os.environ.get("ORDER_QUEUE_SIZE", "1000")
+
+LOG_LEVEL_STR = os.environ.get("LOG_LEVEL", "INFO")
+
+# Load testing: Bot API ကို local stand-in (replay.py) ဆီ ပို့မယ်၊ ဝင်လာတဲ့ updates တွေကို JSONL အဖြစ် သိမ်းမယ်
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+UPDATE_CAPTURE_PATH = os.environ.get("UPDATE_CAPTURE_PATH")
+
+# Prometheus-style metrics endpoint; METRICS_PORT=0 ဆိုရင် ပိတ်ထားမယ်
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT_STR = os.environ.get("METRICS_PORT", "9100")
+
+# Webhook mode: WEBHOOK_URL ထည့်ထားရင် polling အစား webhook နဲ့ run မယ်
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT_STR = os.environ.get("WEBHOOK_PORT") or os.environ.get("PORT", "8443")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "webhook").strip("/")
 
 # --- Variables Validation ---
 ADMIN_ID = 0
@@ -28,6 +51,62 @@ if ADMIN_GROUP_ID_STR:
 else:
     print("⚠️ WARNING: ADMIN_GROUP_ID is not set in environment variables.")
 
+DB_POOL_SIZE = 16
+if DB_POOL_SIZE_STR.isdigit() and int(DB_POOL_SIZE_STR) > 0:
+    DB_POOL_SIZE = int(DB_POOL_SIZE_STR)
+else:
+    print(f"⚠️ WARNING: DB_POOL_SIZE '{DB_POOL_SIZE_STR}' is not a valid number, using {DB_POOL_SIZE}.")
+
+SETTINGS_CACHE_TTL = 30.0
+try:
+    SETTINGS_CACHE_TTL = float(SETTINGS_CACHE_TTL_STR)
+except ValueError:
+    print(f"⚠️ WARNING: SETTINGS_CACHE_TTL '{SETTINGS_CACHE_TTL_STR}' is not a valid number, using {SETTINGS_CACHE_TTL}.")
+
+MAX_CONCURRENT_UPDATES = 64
+if MAX_CONCURRENT_UPDATES_STR.isdigit() and int(MAX_CONCURRENT_UPDATES_STR) > 0:
+    MAX_CONCURRENT_UPDATES = int(MAX_CONCURRENT_UPDATES_STR)
+else:
+    print(f"⚠️ WARNING: MAX_CONCURRENT_UPDATES '{MAX_CONCURRENT_UPDATES_STR}' is not a valid number, using {MAX_CONCURRENT_UPDATES}.")
+
+UPDATE_QUEUE_SIZE = 1000
+if UPDATE_QUEUE_SIZE_STR.isdigit() and int(UPDATE_QUEUE_SIZE_STR) > 0:
+    UPDATE_QUEUE_SIZE = int(UPDATE_QUEUE_SIZE_STR)
+else:
+    print(f"⚠️ WARNING: UPDATE_QUEUE_SIZE '{UPDATE_QUEUE_SIZE_STR}' is not a valid number, using {UPDATE_QUEUE_SIZE}.")
+
+ORDER_WORKERS = 4
+if ORDER_WORKERS_STR.isdigit() and int(ORDER_WORKERS_STR) > 0:
+    ORDER_WORKERS = int(ORDER_WORKERS_STR)
+else:
+    print(f"⚠️ WARNING: ORDER_WORKERS '{ORDER_WORKERS_STR}' is not a valid number, using {ORDER_WORKERS}.")
+
+ORDER_QUEUE_SIZE = 1000
+if ORDER_QUEUE_SIZE_STR.isdigit() and int(ORDER_QUEUE_SIZE_STR) > 0:
+    ORDER_QUEUE_SIZE = int(ORDER_QUEUE_SIZE_STR)
+else:
+    print(f"⚠️ WARNING: ORDER_QUEUE_SIZE '{ORDER_QUEUE_SIZE_STR}' is not a valid number, using {ORDER_QUEUE_SIZE}.")
+
+LOG_LEVEL = LOG_LEVEL_STR.upper()
+if LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+    print(f"⚠️ WARNING: LOG_LEVEL '{LOG_LEVEL_STR}' is not a valid level, using INFO.")
+    LOG_LEVEL = "INFO"
+
+METRICS_PORT = 9100
+if METRICS_PORT_STR.isdigit():
+    METRICS_PORT = int(METRICS_PORT_STR)
+else:
+    print(f"⚠️ WARNING: METRICS_PORT '{METRICS_PORT_STR}' is not a valid number, using {METRICS_PORT}.")
+
+WEBHOOK_PORT = 8443
+if WEBHOOK_PORT_STR.isdigit():
+    WEBHOOK_PORT = int(WEBHOOK_PORT_STR)
+else:
+    print(f"⚠️ WARNING: WEBHOOK_PORT '{WEBHOOK_PORT_STR}' is not a valid number, using {WEBHOOK_PORT}.")
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    print("❌ FATAL ERROR: WEBHOOK_URL is set but WEBHOOK_SECRET is not. Webhook mode will not start without it.")
+
 
 if not BOT_TOKEN:
     print("❌ FATAL ERROR: BOT_TOKEN is not set in environment variables.")
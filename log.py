@@ -0,0 +1,80 @@
+import atexit, contextvars, copy, json, logging, sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from env import LOG_LEVEL
+
+# Correlation fields (update_id, user_id, order_id, topup_id) for the current update/task
+log_context = contextvars.ContextVar("log_context", default={})
+
+listener = None
+
+def bind_log_context(**fields):
+    """Add correlation fields to every log record from the current update/task; returns a reset token"""
+    return log_context.set({**log_context.get(), **fields})
+
+def reset_log_context(token):
+    """Drop correlation fields bound since bind_log_context returned token"""
+    log_context.reset(token)
+
+class ContextQueueHandler(QueueHandler):
+    """QueueHandler that captures the caller's correlation fields and leaves JSON encoding to the listener"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.context = log_context.get()
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "context", {})
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_update_capture(path):
+    """Logger whose records are appended to path as raw lines by a listener thread"""
+    capture_logger = logging.getLogger("update_capture")
+    capture_logger.propagate = False
+    capture_logger.setLevel(logging.INFO)
+    capture_queue = SimpleQueue()
+    capture_logger.addHandler(QueueHandler(capture_queue))
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    capture_listener = QueueListener(capture_queue, file_handler)
+    capture_listener.start()
+    atexit.register(capture_listener.stop)
+    return capture_logger
+
+def setup_logging():
+    """Route all logging through a queue; a listener thread formats and writes JSON to stdout"""
+    global listener
+    if listener:
+        return
+    log_queue = SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -1,48 +1,144 @@
-import json, os, asyncio
-from datetime import datetime, timedelta
-from telegram import Update, Bot
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+import base64, json, os, sys, asyncio, time, logging
+# Taken before the heavier imports so the startup timings include them
+PROCESS_STARTED = time.monotonic()
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, TypeHandler, BaseUpdateProcessor, ChatMemberHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
-from env import BOT_TOKEN, ADMIN_ID, ADMIN_GROUP_ID, MONGO_URI
-from pymongo import MongoClient
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+import httpx
+from env import (
+    BOT_TOKEN, ADMIN_ID, ADMIN_GROUP_ID, MONGO_URI, DB_POOL_SIZE, SETTINGS_CACHE_TTL, MAX_CONCURRENT_UPDATES,
+    UPDATE_QUEUE_SIZE, ORDER_WORKERS, ORDER_QUEUE_SIZE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT,
+    WEBHOOK_PATH, METRICS_LISTEN, METRICS_PORT, TELEGRAM_API_URL, UPDATE_CAPTURE_PATH
+)
+from pymongo import MongoClient, UpdateOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from bson import ObjectId
+from log import setup_logging, setup_update_capture, bind_log_context, reset_log_context
 
-# MongoDB Connection
-client = MongoClient(MONGO_URI)
+logger = logging.getLogger("mlbb_bot")
+
+# MongoDB Connection (connect=False defers SRV lookup and server discovery to the first query)
+client = MongoClient(MONGO_URI, connect=False)
 db = client.mlbb_bot
 users_collection = db.users
 orders_collection = db.orders
 topups_collection = db.topups
 settings_collection = db.settings
 clone_bots_collection = db.clone_bots
-
-# Initialize collections
-if settings_collection.count_documents({}) == 0:
-    settings_collection.insert_one({
-        "authorized_users": [],
-        "admin_ids": [ADMIN_ID],
-        "prices": {},
-        "payment_info": {
-            "kpay_number": "09678786528",
-            "kpay_name": "Ma May Phoo Wai",
-            "kpay_image": None,
-            "wave_number": "09673585480", 
-            "wave_name": "Nine Nine",
-            "wave_image": None
-        },
-        "bot_maintenance": {
-            "orders": True,
-            "topups": True,
-            "general": True
-        }
-    })
+counters_collection = db.counters
+sessions_collection = db.sessions
+
+# Bounded thread pool for blocking pymongo calls, keeps the event loop free
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mongo")
+
+# Settings document created on first startup
+DEFAULT_SETTINGS = {
+    "authorized_users": [],
+    "admin_ids": [ADMIN_ID],
+    "prices": {},
+    "payment_info": {
+        "kpay_number": "09678786528",
+        "kpay_name": "Ma May Phoo Wai",
+        "kpay_image": None,
+        "wave_number": "09673585480",
+        "wave_name": "Nine Nine",
+        "wave_image": None
+    },
+    "bot_maintenance": {
+        "orders": True,
+        "topups": True,
+        "general": True
+    }
+}
+
+# Default prices
+WEEKLY_PASS_PRICE = 6000
+WEEKLY_PASS_PRICES = {f"wp{n}": n * WEEKLY_PASS_PRICE for n in range(1, 11)}
+REGULAR_DIAMOND_PRICES = {
+    "11": 950, "22": 1900, "33": 2850, "56": 4200, "86": 5100, "112": 8200,
+    "172": 10200, "257": 15300, "343": 20400, "429": 25500, "514": 30600,
+    "600": 35700, "706": 40800, "878": 51000, "963": 56100, "1049": 61200,
+    "1135": 66300, "1412": 81600, "2195": 122400, "3688": 204000,
+    "5532": 306000, "9288": 510000, "12976": 714000
+}
+DOUBLE_PASS_PRICES = {"55": 3500, "165": 10000, "275": 16000, "565": 33000}
+DEFAULT_PRICES = {**WEEKLY_PASS_PRICES, **REGULAR_DIAMOND_PRICES, **DOUBLE_PASS_PRICES}
+
+# IDs reserved from the shared counter per round trip
+ID_BLOCK_SIZE = 100
+
+# Session lifetimes in MongoDB (removed by the TTL index) and the local read-through cache TTL
+USER_STATE_TTL = timedelta(days=7)
+PENDING_TOPUP_TTL = timedelta(days=1)
+SESSION_CACHE_TTL = 5
+MAX_SESSION_CACHE = 50000
+
+# Telegram send limits: ~30 msg/s overall, ~1 msg/s per chat, ~20 msg/min per group
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_GROUP_RATE = 20 / 60
+MAX_CHAT_BUCKETS = 10000
+SEND_RETRIES = 3
+SEND_BACKOFF = 0.5
+
+# Latency histogram buckets in seconds
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# button_callback branches, for per-branch latency labels
+CALLBACK_BRANCHES = (
+    "topup_pay_", "request_register", "register_approve_", "register_reject_", "topup_cancel",
+    "topup_approve_", "topup_reject_", "order_confirm_", "order_cancel_", "hist_", "topup_button",
+    "copy_kpay", "copy_wave"
+)
+
+# Cached profile photo file_ids, fetched in the background on a miss
+PROFILE_PHOTO_CACHE_TTL = 3600
+MAX_PROFILE_PHOTO_CACHE = 50000
+
+# Fallback refresh for cached group admin status; my_chat_member updates refresh it immediately.
+# A failed check is only cached briefly so a Telegram hiccup doesn't disable group features for long.
+GROUP_ADMIN_CACHE_TTL = 600
+GROUP_ADMIN_ERROR_TTL = 30
+
+# Orders and topups shown per /history page
+HISTORY_PAGE_SIZE = 10
+# Status marks in /history; anything else (pending) shows ⏳
+HISTORY_STATUS_EMOJI = {"completed": "✅", "approved": "✅", "cancelled": "❌", "rejected": "❌"}
+EPOCH = datetime(1970, 1, 1)
+
+# Most IDs one bulk admin command will process
+BULK_ACTION_LIMIT = 100
+
+# How long shutdown waits for queued order notifications to go out
+ORDER_DRAIN_TIMEOUT = 30
 
 # Global variables
 AUTHORIZED_USERS = set()
-user_states = {}
-pending_topups = {}
+authorized_users_source = None
+session_cache = {}
+compiled_prices = None
 clone_bot_apps = {}
-order_queue = asyncio.Queue()
+order_queue = asyncio.Queue(maxsize=ORDER_QUEUE_SIZE)
+order_workers = []
+order_pipeline_stats = {"enqueued": 0, "processed": 0, "failed": 0, "max_depth": 0}
+settings_cache = {"data": None, "expires_at": 0, "version": 0}
+id_blocks = {}
+id_block_lock = asyncio.Lock()
+chat_buckets = {}
+group_admin_cache = {}
+profile_photo_cache = {}
+profile_photo_fetches = set()
+settings_cache_lock = asyncio.Lock()
+metrics_server = None
+startup_tasks = {}
+startup_stats = {"ready_seconds": None, "first_update_seconds": None}
+bot_ready = asyncio.Event()
 
 def is_user_authorized(user_id):
     """Check if user is authorized to use the bot"""
@@ -52,122 +148,1257 @@ def is_owner(user_id):
     """Check if user is the owner"""
     return int(user_id) == ADMIN_ID
 
-def is_admin(user_id):
+async def is_admin(user_id):
     """Check if user is any admin"""
     if int(user_id) == ADMIN_ID:
         return True
-    settings = settings_collection.find_one({})
-    admin_list = settings.get("admin_ids", [])
+    admin_list = await get_admin_ids()
     return int(user_id) in admin_list
 
+@dataclass
+class UserProfile:
+    """Balance and profile fields of a user document"""
+    user_id: str
+    name: str = "Unknown"
+    username: str = "None"
+    balance: int = 0
+    pending_topup_count: int = 0
+    pending_topup_amount: int = 0
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Build from a (projected) user document"""
+        return cls(**{f.name: doc[f.name] for f in fields(cls) if f.name in doc})
+
+USER_PROFILE_FIELDS = tuple(f.name for f in fields(UserProfile))
+
+@dataclass
+class UpdateState:
+    """Auth, maintenance and session state resolved once per update"""
+    user_id: str
+    profile: UserProfile = None
+    is_authorized: bool = False
+    is_admin: bool = False
+    maintenance: dict = field(default_factory=dict)
+    waiting_approval: bool = False
+    in_topup_process: bool = False
+    has_pending_topup: bool = False
+
+    def is_open(self, command_type):
+        """Check if specific command type is open (not in maintenance mode)"""
+        return self.maintenance.get(command_type, True)
+
+class UpdateIntake(asyncio.Queue):
+    """Application.update_queue that notes each update's arrival and bounds the updates in flight
+
+    PTB's fetcher turns every update it gets into a task straight away, so a bounded queue
+    alone never fills. get() therefore waits for one of max_in_flight slots, returned by
+    task_done() once PTB has processed the update. When every slot is taken the queue fills
+    and put() blocks: polling stops fetching and the webhook stops answering until the
+    backlog drains.
+    """
+
+    def __init__(self, maxsize, max_in_flight, on_arrival=None):
+        super().__init__(maxsize)
+        self._in_flight_slots = asyncio.Semaphore(max_in_flight)
+        self._on_arrival = on_arrival
+        self.in_flight = 0
+
+    async def put(self, item):
+        """Note the update's arrival before it waits for room, a handler slot or its user's lock"""
+        if isinstance(item, Update):
+            if startup_stats["first_update_seconds"] is None:
+                startup_stats["first_update_seconds"] = time.monotonic() - PROCESS_STARTED
+                logger.info("First update %.2fs after process start", startup_stats["first_update_seconds"])
+            if self._on_arrival:
+                self._on_arrival(item)
+        await super().put(item)
+
+    async def get(self):
+        """Wait for an in-flight slot, then take the next update"""
+        await self._in_flight_slots.acquire()
+        try:
+            item = await super().get()
+        except BaseException:
+            self._in_flight_slots.release()
+            raise
+        self.in_flight += 1
+        return item
+
+    def task_done(self):
+        """Mark an update processed and free its in-flight slot"""
+        self.in_flight -= 1
+        self._in_flight_slots.release()
+        super().task_done()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across users while keeping each user's updates in order"""
+
+    def __init__(self, max_concurrent_updates):
+        # The base class takes its semaphore before do_process_update, so a user's queued updates
+        # would hold slots while waiting for their lock. Handler concurrency is limited under the lock instead.
+        super().__init__(sys.maxsize)
+        self.handler_limit = max_concurrent_updates
+        self._handler_slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+        self.running = 0
+
+    async def do_process_update(self, update, coroutine):
+        """Await the update's coroutine under its user's lock, then a handler slot"""
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        if key is None:
+            async with self._handler_slots:
+                await self._run(coroutine)
+            return
+
+        # asyncio.Lock wakes waiters in FIFO order, so a user's updates keep their order
+        lock_entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        lock_entry[1] += 1
+        try:
+            async with lock_entry[0]:
+                async with self._handler_slots:
+                    await self._run(coroutine)
+        finally:
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                del self._user_locks[key]
+
+    async def _run(self, coroutine):
+        """Await the update's coroutine, counted in running"""
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+
+    async def initialize(self):
+        """Nothing to set up"""
+
+    async def shutdown(self):
+        """Nothing to tear down"""
+
+async def resolve_update_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Build the per-update state before any handler runs"""
+    user = update.effective_user
+    if user is None:
+        return
+
+    user_id = str(user.id)
+    bind_log_context(update_id=update.update_id, user_id=user_id)
+    await load_authorized_users()
+    state = UpdateState(
+        user_id=user_id,
+        is_authorized=is_user_authorized(user_id),
+        is_admin=await is_admin(user_id),
+        maintenance=await get_bot_maintenance()
+    )
+
+    # Only authorized users need their document and session, and each is fetched at most once
+    if state.is_authorized:
+        state.profile, user_state, pending_topup = await asyncio.gather(
+            get_user_profile(user_id),
+            get_user_state(user_id),
+            get_pending_topup(user_id)
+        )
+        state.has_pending_topup = has_pending_topup(state.profile)
+        state.waiting_approval = user_state == "waiting_approval"
+        state.in_topup_process = pending_topup is not None
+
+    context.update_state = state
+
+def utc_now():
+    """Naive UTC now; the TTL monitor compares in UTC and pymongo reads dates back as naive UTC"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def cache_session(key, data, expires_at):
+    """Put session data in the local cache, pruning expired entries when it is full"""
+    if key not in session_cache and len(session_cache) >= MAX_SESSION_CACHE:
+        now = time.monotonic()
+        for expired_key in [k for k, entry in session_cache.items() if entry[1] <= now]:
+            del session_cache[expired_key]
+        if len(session_cache) >= MAX_SESSION_CACHE:
+            # Everything is still fresh: drop the oldest entry, it's only a read-through cache
+            del session_cache[next(iter(session_cache))]
+    session_cache[key] = (data, expires_at)
+
+async def get_session(kind, user_id, fresh=False):
+    """Get session data from MongoDB through the local read-through cache"""
+    key = f"{kind}:{user_id}"
+    cached = session_cache.get(key)
+    if not fresh and cached and time.monotonic() < cached[1]:
+        return cached[0]
+    doc = await run_db(sessions_collection.find_one, {"_id": key})
+    # The TTL monitor only runs once a minute, so check expiry here too
+    data = doc["data"] if doc and doc["expires_at"] > utc_now() else None
+    cache_session(key, data, time.monotonic() + SESSION_CACHE_TTL)
+    return data
+
+async def set_session(kind, user_id, data, ttl):
+    """Save session data to MongoDB and the local cache"""
+    key = f"{kind}:{user_id}"
+    await run_db(
+        sessions_collection.update_one,
+        {"_id": key},
+        {"$set": {"user_id": str(user_id), "kind": kind, "data": data, "expires_at": utc_now() + ttl}},
+        upsert=True
+    )
+    cache_session(key, data, time.monotonic() + SESSION_CACHE_TTL)
+
+async def clear_session(kind, user_id):
+    """Remove session data from MongoDB and the local cache"""
+    key = f"{kind}:{user_id}"
+    await run_db(sessions_collection.delete_one, {"_id": key})
+    cache_session(key, None, time.monotonic() + SESSION_CACHE_TTL)
+
+async def clear_sessions(kind, user_ids):
+    """Remove many users' session data from MongoDB and the local cache in one delete"""
+    keys = [f"{kind}:{user_id}" for user_id in user_ids]
+    await run_db(sessions_collection.delete_many, {"_id": {"$in": keys}})
+    expires_at = time.monotonic() + SESSION_CACHE_TTL
+    for key in keys:
+        cache_session(key, None, expires_at)
+
+async def get_user_state(user_id, fresh=False):
+    """Get user restriction state (e.g. waiting_approval)"""
+    return await get_session("user_state", user_id, fresh)
+
+async def set_user_state(user_id, user_state):
+    """Save user restriction state"""
+    await set_session("user_state", user_id, user_state, USER_STATE_TTL)
+
+async def clear_user_state(user_id):
+    """Clear user restriction state"""
+    await clear_session("user_state", user_id)
+
+async def clear_user_states(user_ids):
+    """Clear restriction state for many users"""
+    await clear_sessions("user_state", user_ids)
+
+async def get_pending_topup(user_id, fresh=False):
+    """Get the user's in-progress topup"""
+    return await get_session("pending_topup", user_id, fresh)
+
+async def set_pending_topup(user_id, pending):
+    """Save the user's in-progress topup"""
+    await set_session("pending_topup", user_id, pending, PENDING_TOPUP_TTL)
+
+async def clear_pending_topup(user_id):
+    """Clear the user's in-progress topup"""
+    await clear_session("pending_topup", user_id)
+
 async def is_bot_admin_in_group(bot, chat_id):
-    """Check if bot is admin in the group"""
+    """Check if bot is admin in the group (cached, refreshed by my_chat_member updates)"""
+    cached = group_admin_cache.get(chat_id)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
     try:
-        me = await bot.get_me()
-        bot_member = await bot.get_chat_member(chat_id, me.id)
+        # bot.id comes from the get_me() done once at Application startup
+        bot_member = await bot.get_chat_member(chat_id, bot.id)
         is_admin = bot_member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
-        print(f"Bot admin check for group {chat_id}: {is_admin}, status: {bot_member.status}")
-        return is_admin
+        logger.info("Bot admin check for group %s: %s, status: %s", chat_id, is_admin, bot_member.status)
+        ttl = GROUP_ADMIN_CACHE_TTL
     except Exception as e:
-        print(f"Error checking bot admin status in group {chat_id}: {e}")
-        return False
+        logger.error("Error checking bot admin status in group %s: %s", chat_id, e)
+        is_admin = False
+        ttl = GROUP_ADMIN_ERROR_TTL
+    group_admin_cache[chat_id] = (is_admin, time.monotonic() + ttl)
+    return is_admin
+
+async def track_bot_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Update cached group admin status when the bot's own membership changes"""
+    member_update = update.my_chat_member
+    is_admin = member_update.new_chat_member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+    group_admin_cache[member_update.chat.id] = (is_admin, time.monotonic() + GROUP_ADMIN_CACHE_TTL)
+    logger.info("Bot membership changed in %s: %s", member_update.chat.id, member_update.new_chat_member.status)
+
+class Histogram:
+    """Prometheus-style latency histogram, one series per set of label values"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+
+    def observe(self, label_values, seconds):
+        """Record one observation for the given label values"""
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                series["buckets"][i] += 1
+        series["sum"] += seconds
+        series["count"] += 1
+
+    def render(self):
+        """Render in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.series.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(METRIC_BUCKETS, series["buckets"]):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return "\n".join(lines)
+
+handler_latency = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+mongo_latency = Histogram("bot_mongo_seconds", "MongoDB call latency including executor wait", ("collection", "operation"))
+telegram_latency = Histogram("bot_telegram_seconds", "Telegram Bot API call latency", ("method", "status"))
+
+def mongo_call_labels(func, args):
+    """Collection and operation labels for a run_db call"""
+    target = getattr(func, "__self__", None)
+    if func is list and args:
+        # run_db(list, cursor) drains a find() cursor
+        return getattr(getattr(args[0], "collection", None), "name", ""), "find"
+    if func is in_transaction and args:
+        return "transaction", getattr(args[0], "__name__", "call")
+    return getattr(target, "name", ""), getattr(func, "__name__", "call")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking pymongo call on the bounded DB executor"""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+    finally:
+        mongo_latency.observe(mongo_call_labels(func, args), time.perf_counter() - started)
 
-def load_authorized_users():
-    """Load authorized users from MongoDB"""
-    global AUTHORIZED_USERS
-    settings = settings_collection.find_one({})
-    AUTHORIZED_USERS = set(str(uid) for uid in settings.get("authorized_users", []))
+transactions_supported = True
 
-def save_authorized_users():
-    """Save authorized users to MongoDB"""
-    settings_collection.update_one(
+def in_transaction(callback):
+    """Run callback(session) as one MongoDB transaction; returns its result
+
+    with_transaction retries the whole callback on transient errors. Standalone mongod
+    and mongomock have no transactions, so there the callback runs once with session=None
+    and is responsible for undoing its own partial writes.
+    """
+    global transactions_supported
+    if transactions_supported:
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(callback)
+        except NotImplementedError:
+            transactions_supported = False
+        except OperationFailure as e:
+            # IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+            if e.code != 20 or "Transaction numbers" not in str(e):
+                raise
+            transactions_supported = False
+        logger.warning("MongoDB transactions are unavailable; multi-document writes run without them")
+    return callback(None)
+
+async def get_settings():
+    """Get the settings document, served from the in-process cache while fresh"""
+    if settings_cache["data"] is not None and time.monotonic() < settings_cache["expires_at"]:
+        return settings_cache["data"]
+    async with settings_cache_lock:
+        # Another update may have refreshed the cache while we waited
+        if settings_cache["data"] is not None and time.monotonic() < settings_cache["expires_at"]:
+            return settings_cache["data"]
+        version = settings_cache["version"]
+        settings = await run_db(settings_collection.find_one, {}) or {}
+        # Don't cache a snapshot that a concurrent save has already made stale
+        if version == settings_cache["version"]:
+            settings_cache["data"] = settings
+            settings_cache["expires_at"] = time.monotonic() + SETTINGS_CACHE_TTL
+        return settings
+
+async def load_settings():
+    """Fetch the settings document into the cache, creating it with the defaults on first run"""
+    # One round trip: $setOnInsert leaves an existing document untouched
+    settings = await run_db(
+        settings_collection.find_one_and_update,
         {},
-        {"$set": {"authorized_users": [int(uid) for uid in AUTHORIZED_USERS]}}
+        {"$setOnInsert": DEFAULT_SETTINGS},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    async with settings_cache_lock:
+        settings_cache["data"] = settings
+        settings_cache["expires_at"] = time.monotonic() + SETTINGS_CACHE_TTL
+    return settings
+
+def invalidate_settings_cache():
+    """Drop the cached settings so the next read goes to MongoDB"""
+    settings_cache["data"] = None
+    settings_cache["expires_at"] = 0
+    settings_cache["version"] += 1
+
+async def save_settings_field(field_name, value):
+    """Save a single settings field to MongoDB and invalidate the cache"""
+    await run_db(
+        settings_collection.update_one,
+        {},
+        {"$set": {field_name: value}}
+    )
+    invalidate_settings_cache()
 
-def get_prices():
+async def load_authorized_users():
+    """Load authorized users from MongoDB"""
+    global AUTHORIZED_USERS, authorized_users_source
+    settings = await get_settings()
+    # Rebuild only from a new cached snapshot; a stale read racing a save never replaces the set
+    if settings is settings_cache["data"] and settings is not authorized_users_source:
+        AUTHORIZED_USERS = set(str(uid) for uid in settings.get("authorized_users", []))
+        authorized_users_source = settings
+
+async def authorize_user(user_id):
+    """Add a user to the authorized users in MongoDB; returns False if they already were"""
+    # $addToSet edits the stored list, so approvals on other replicas or a stale cache aren't lost
+    result = await run_db(
+        settings_collection.update_one,
+        {},
+        {"$addToSet": {"authorized_users": int(user_id)}}
+    )
+    invalidate_settings_cache()
+    AUTHORIZED_USERS.add(str(user_id))
+    return result.modified_count > 0
+
+async def get_admin_ids():
+    """Get admin ID list from MongoDB"""
+    settings = await get_settings()
+    return settings.get("admin_ids", [ADMIN_ID])
+
+async def get_prices():
     """Get prices from MongoDB"""
-    settings = settings_collection.find_one({})
+    settings = await get_settings()
     return settings.get("prices", {})
 
-def save_prices(prices):
+async def save_prices(prices):
     """Save prices to MongoDB"""
-    settings_collection.update_one(
-        {},
-        {"$set": {"prices": prices}}
-    )
+    global compiled_prices
+    await save_settings_field("prices", prices)
+    compiled_prices = None
 
-def get_payment_info():
+async def get_payment_info():
     """Get payment info from MongoDB"""
-    settings = settings_collection.find_one({})
+    settings = await get_settings()
     return settings.get("payment_info", {})
 
-def save_payment_info(payment_info):
+async def save_payment_info(payment_info):
     """Save payment info to MongoDB"""
-    settings_collection.update_one(
-        {},
-        {"$set": {"payment_info": payment_info}}
-    )
+    await save_settings_field("payment_info", payment_info)
 
-def get_bot_maintenance():
+async def get_bot_maintenance():
     """Get bot maintenance status from MongoDB"""
-    settings = settings_collection.find_one({})
+    settings = await get_settings()
     return settings.get("bot_maintenance", {})
 
-def save_bot_maintenance(bot_maintenance):
+async def save_bot_maintenance(bot_maintenance):
     """Save bot maintenance status to MongoDB"""
-    settings_collection.update_one(
-        {},
-        {"$set": {"bot_maintenance": bot_maintenance}}
-    )
+    await save_settings_field("bot_maintenance", bot_maintenance)
+
+async def get_user(user_id, projection=None):
+    """Get user from MongoDB, limited to the given fields when a projection is passed"""
+    if projection is not None:
+        projection = {"_id": 0, **{field_name: 1 for field_name in projection}}
+    return await run_db(users_collection.find_one, {"user_id": str(user_id)}, projection)
 
-def get_user(user_id):
-    """Get user from MongoDB"""
-    return users_collection.find_one({"user_id": str(user_id)})
+async def get_user_profile(user_id):
+    """Get the user's balance and profile fields from MongoDB"""
+    user_data = await get_user(user_id, USER_PROFILE_FIELDS)
+    return UserProfile.from_doc(user_data) if user_data else None
 
-def save_user(user_data):
+async def save_user(user_data):
     """Save user to MongoDB"""
-    users_collection.update_one(
+    await run_db(
+        users_collection.update_one,
         {"user_id": user_data["user_id"]},
         {"$set": user_data},
         upsert=True
     )
 
-def create_user(user_id, name, username):
+async def create_user(user_id, name, username):
     """Create new user in MongoDB"""
     user_data = {
         "user_id": str(user_id),
         "name": name,
         "username": username,
         "balance": 0,
-        "orders": [],
-        "topups": [],
+        "pending_topup_count": 0,
+        "pending_topup_amount": 0,
         "created_at": datetime.now().isoformat()
     }
-    save_user(user_data)
+    await save_user(user_data)
     return user_data
 
-def add_user_order(user_id, order_data):
-    """Add order to user in MongoDB"""
-    users_collection.update_one(
+async def add_user_topup(user_id, topup_data):
+    """Add pending topup to the topups collection and the user's pending counters in MongoDB"""
+    result = await run_db(
+        topups_collection.insert_one,
+        {**topup_data, "user_id": str(user_id), "created_at": datetime.now()}
+    )
+    try:
+        await run_db(
+            users_collection.update_one,
+            {"user_id": str(user_id)},
+            {"$inc": {"pending_topup_count": 1, "pending_topup_amount": topup_data["amount"]}}
+        )
+    except Exception:
+        # Undo the insert so the pending counters never disagree with the topups collection
+        await run_db(topups_collection.delete_one, {"_id": result.inserted_id})
+        raise
+
+def credit_in_session(session, user_id, increments):
+    """Apply balance/counter increments to a user inside a transaction; returns new balance or None"""
+    user_data = users_collection.find_one_and_update(
         {"user_id": str(user_id)},
-        {"$push": {"orders": order_data}}
+        {"$inc": increments},
+        projection={"balance": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
     )
+    return user_data["balance"] if user_data else None
 
-def add_user_topup(user_id, topup_data):
-    """Add topup to user in MongoDB"""
-    users_collection.update_one(
-        {"user_id": str(user_id)},
-        {"$push": {"topups": topup_data}}
+async def settle_topup(query, approved_by, sort=None):
+    """Approve one pending topup and credit its amount in one transaction
+
+    Returns (topup, new balance); topup is None if no pending topup matched.
+    """
+    def approve_and_credit(session):
+        topup = topups_collection.find_one_and_update(query, {"$set": {
+            "status": "approved",
+            "approved_by": approved_by,
+            "approved_at": datetime.now().isoformat()
+        }}, sort=sort, session=session)
+        if not topup:
+            return None, None
+        try:
+            new_balance = credit_in_session(session, topup["user_id"], {
+                "balance": topup["amount"],
+                "pending_topup_count": -1,
+                "pending_topup_amount": -topup["amount"]
+            })
+        except Exception:
+            if session is None:
+                # No transaction to roll back: put the topup back so it can be approved again
+                topups_collection.update_one({"_id": topup["_id"]}, {"$set": {"status": "pending"}})
+            raise
+        return topup, new_balance
+    return await run_db(in_transaction, approve_and_credit)
+
+async def approve_topup(topup_id, approved_by):
+    """Approve and credit a pending topup; returns (topup, new balance), topup None if already handled"""
+    return await settle_topup({"topup_id": topup_id, "status": "pending"}, approved_by)
+
+async def approve_latest_pending_topup(user_id, amount, approved_by):
+    """Approve and credit the user's newest pending topup for an amount; returns (topup, new balance)"""
+    return await settle_topup(
+        {"user_id": str(user_id), "status": "pending", "amount": amount},
+        approved_by,
+        sort=[("created_at", -1)]
     )
 
-def update_user_balance(user_id, new_balance):
-    """Update user balance in MongoDB"""
-    users_collection.update_one(
+async def reject_topup(topup_id, rejected_by):
+    """Move a topup from pending to rejected and release the user's pending counters in one transaction"""
+    def reject_and_release(session):
+        topup = topups_collection.find_one_and_update(
+            {"topup_id": topup_id, "status": "pending"},
+            {"$set": {
+                "status": "rejected",
+                "rejected_by": rejected_by,
+                "rejected_at": datetime.now().isoformat()
+            }},
+            session=session
+        )
+        if topup:
+            users_collection.update_one(
+                {"user_id": topup["user_id"]},
+                {"$inc": {"pending_topup_count": -1, "pending_topup_amount": -topup["amount"]}},
+                session=session
+            )
+        return topup
+    return await run_db(in_transaction, reject_and_release)
+
+async def confirm_order(order_id, confirmed_by):
+    """Move an order from pending to completed; returns the order or None if already handled"""
+    return await run_db(
+        orders_collection.find_one_and_update,
+        {"order_id": order_id, "status": "pending"},
+        {"$set": {
+            "status": "completed",
+            "confirmed_by": confirmed_by,
+            "confirmed_at": datetime.now().isoformat()
+        }}
+    )
+
+async def cancel_order(order_id, cancelled_by):
+    """Move an order from pending to cancelled and refund its price in one transaction; returns the order or None"""
+    def cancel_and_refund(session):
+        order = orders_collection.find_one_and_update(
+            {"order_id": order_id, "status": "pending"},
+            {"$set": {
+                "status": "cancelled",
+                "cancelled_by": cancelled_by,
+                "cancelled_at": datetime.now().isoformat()
+            }},
+            session=session
+        )
+        if order:
+            try:
+                credit_in_session(session, order["user_id"], {"balance": order["price"]})
+            except Exception:
+                if session is None:
+                    # No transaction to roll back: put the order back so it can be cancelled again
+                    orders_collection.update_one({"_id": order["_id"]}, {"$set": {"status": "pending"}})
+                raise
+        return order
+    return await run_db(in_transaction, cancel_and_refund)
+
+def claim_pending(session, collection, id_field, ids, status, action, actor):
+    """Move the pending documents among ids to status in one update_many; returns the ones moved
+
+    Each call tags what it moved with its own batch id, so concurrent admins never both
+    get (and act on) the same document.
+    """
+    batch_id = str(ObjectId())
+    query = {id_field: {"$in": list(ids)}, "status": "pending"}
+    collection.update_many(query, {"$set": {
+        "status": status,
+        f"{action}_by": actor,
+        f"{action}_at": datetime.now().isoformat(),
+        "batch_id": batch_id
+    }}, session=session)
+    return list(collection.find({id_field: {"$in": list(ids)}, "batch_id": batch_id}, session=session))
+
+def release_unsettled(collection, docs, user_ids, error):
+    """Without a transaction, put claimed documents whose user write failed back to pending"""
+    if isinstance(error, BulkWriteError):
+        failed = {user_ids[write_error["index"]] for write_error in error.details["writeErrors"]}
+    else:
+        failed = set(user_ids)
+    collection.update_many(
+        {"_id": {"$in": [doc["_id"] for doc in docs if doc["user_id"] in failed]}},
+        {"$set": {"status": "pending"}}
+    )
+
+async def bulk_confirm_orders(order_ids, confirmed_by):
+    """Confirm many pending orders in one write; returns the confirmed orders"""
+    def confirm(session):
+        return claim_pending(session, orders_collection, "order_id", order_ids, "completed", "confirmed", confirmed_by)
+    return await run_db(in_transaction, confirm)
+
+async def bulk_cancel_orders(order_ids, cancelled_by):
+    """Cancel many pending orders and refund them in one bulk write, in one transaction; returns the cancelled orders"""
+    def cancel_and_refund(session):
+        orders = claim_pending(session, orders_collection, "order_id", order_ids, "cancelled", "cancelled", cancelled_by)
+        refunds = {}
+        for order in orders:
+            refunds[order["user_id"]] = refunds.get(order["user_id"], 0) + order["price"]
+        if refunds:
+            try:
+                users_collection.bulk_write([
+                    UpdateOne({"user_id": user_id}, {"$inc": {"balance": amount}})
+                    for user_id, amount in refunds.items()
+                ], ordered=False, session=session)
+            except Exception as e:
+                if session is None:
+                    release_unsettled(orders_collection, orders, list(refunds), e)
+                raise
+        return orders
+    return await run_db(in_transaction, cancel_and_refund)
+
+async def bulk_approve_topups(topup_ids, approved_by):
+    """Approve many pending topups and credit them in one bulk write, in one transaction
+
+    Returns the approved topups and the credited users' new balances.
+    """
+    def approve_and_credit(session):
+        topups = claim_pending(session, topups_collection, "topup_id", topup_ids, "approved", "approved", approved_by)
+        credits = {}
+        for topup in topups:
+            credit = credits.setdefault(topup["user_id"], {"count": 0, "amount": 0})
+            credit["count"] += 1
+            credit["amount"] += topup["amount"]
+        balances = {}
+        if credits:
+            try:
+                users_collection.bulk_write([
+                    UpdateOne({"user_id": user_id}, {"$inc": {
+                        "balance": credit["amount"],
+                        "pending_topup_count": -credit["count"],
+                        "pending_topup_amount": -credit["amount"]
+                    }})
+                    for user_id, credit in credits.items()
+                ], ordered=False, session=session)
+            except Exception as e:
+                if session is None:
+                    release_unsettled(topups_collection, topups, list(credits), e)
+                raise
+            cursor = users_collection.find(
+                {"user_id": {"$in": list(credits)}}, {"_id": 0, "user_id": 1, "balance": 1}, session=session
+            )
+            balances = {user_data["user_id"]: user_data["balance"] for user_data in cursor}
+        return topups, balances
+    topups, balances = await run_db(in_transaction, approve_and_credit)
+    if topups:
+        await clear_user_states({topup["user_id"] for topup in topups})
+    return topups, balances
+
+def history_key_range(operator, key):
+    """Query for entries strictly past a (created_at, _id) key; _id breaks created_at ties"""
+    created_at, _id = key
+    return {"$or": [
+        {"created_at": {operator: created_at}},
+        {"created_at": created_at, "_id": {operator: _id}}
+    ]}
+
+async def get_history_window(collection, projection, user_id, limit, before=None, after=None):
+    """Get one window of orders/topups from MongoDB, newest first, via the user_id/created_at/_id index"""
+    query = {"user_id": str(user_id)}
+    if after is not None:
+        # Walking back towards newer entries: take the nearest ones, then restore newest-first
+        query.update(history_key_range("$gt", after))
+        cursor = collection.find(query, projection, sort=[("created_at", 1), ("_id", 1)], limit=limit)
+        return list(reversed(await run_db(list, cursor)))
+    if before is not None:
+        query.update(history_key_range("$lt", before))
+    cursor = collection.find(query, projection, sort=[("created_at", -1), ("_id", -1)], limit=limit)
+    return await run_db(list, cursor)
+
+async def get_user_orders(user_id, limit, before=None, after=None):
+    """Get a window of the user's orders from MongoDB"""
+    projection = {"order_id": 1, "amount": 1, "price": 1, "status": 1, "created_at": 1}
+    return await get_history_window(orders_collection, projection, user_id, limit, before, after)
+
+async def get_user_topups(user_id, limit, before=None, after=None):
+    """Get a window of the user's topups from MongoDB"""
+    projection = {"amount": 1, "status": 1, "timestamp": 1, "created_at": 1}
+    return await get_history_window(topups_collection, projection, user_id, limit, before, after)
+
+def history_key(entry):
+    """Paging key of an order/topup: created_at, with _id ordering same-millisecond entries"""
+    return entry["created_at"], entry["_id"]
+
+def to_history_cursor(entry):
+    """Encode an entry's paging key for callback data: epoch ms (MongoDB's precision) and base64 _id"""
+    created_at, _id = history_key(entry)
+    ms = (created_at - EPOCH) // timedelta(milliseconds=1)
+    return f"{ms}.{base64.b64encode(_id.binary).decode()}"
+
+def from_history_cursor(cursor, direction):
+    """Decode a paging key from callback data"""
+    ms, _, encoded_id = cursor.partition(".")
+    if encoded_id:
+        _id = ObjectId(base64.b64decode(encoded_id))
+    else:
+        # Buttons sent before _id was part of the cursor: exclude the whole boundary millisecond as they did
+        _id = ObjectId("0" * 24 if direction == "n" else "f" * 24)
+    return EPOCH + timedelta(milliseconds=int(ms)), _id
+
+async def render_history_page(user_id, page=0, direction=None, cursor=None):
+    """Build one /history page and its prev/next buttons; returns (msg, reply_markup) or None when empty"""
+    # Keyset paging on (created_at, _id) across both collections: each page is two index range
+    # scans of at most one page, whatever the history length
+    limit = HISTORY_PAGE_SIZE + 1
+    bounds = {}
+    if direction == "n":
+        bounds = {"before": from_history_cursor(cursor, direction)}
+    elif direction == "p":
+        bounds = {"after": from_history_cursor(cursor, direction)}
+    orders, topups = await asyncio.gather(
+        get_user_orders(user_id, limit, **bounds),
+        get_user_topups(user_id, limit, **bounds)
+    )
+
+    # Merge newest first; the extra entry only says whether more exist in the direction we walked
+    entries = sorted(
+        [("order", order) for order in orders] + [("topup", topup) for topup in topups],
+        key=lambda entry: history_key(entry[1]),
+        reverse=True
+    )
+    has_more = len(entries) > HISTORY_PAGE_SIZE
+    entries = entries[-HISTORY_PAGE_SIZE:] if direction == "p" else entries[:HISTORY_PAGE_SIZE]
+
+    if not entries:
+        return None
+
+    msg = f"📋 သင့်ရဲ့ မှတ်တမ်းများ (စာမျက်နှာ {page + 1})\n\n"
+
+    page_orders = [entry for kind, entry in reversed(entries) if kind == "order"]
+    page_topups = [entry for kind, entry in reversed(entries) if kind == "topup"]
+
+    if page_orders:
+        msg += "🛒 အော်ဒါများ:\n"
+        for order in page_orders:
+            status_emoji = HISTORY_STATUS_EMOJI.get(order.get("status"), "⏳")
+            msg += f"{status_emoji} {order['order_id']} - {order['amount']} ({order['price']:,} MMK)\n"
+        msg += "\n"
+
+    if page_topups:
+        msg += "💳 ငွေဖြည့်များ:\n"
+        for topup in page_topups:
+            status_emoji = HISTORY_STATUS_EMOJI.get(topup.get("status"), "⏳")
+            msg += f"{status_emoji} {topup['amount']:,} MMK - {topup.get('timestamp', 'Unknown')[:10]}\n"
+
+    buttons = []
+    if page > 0 and (direction != "p" or has_more):
+        newest = to_history_cursor(entries[0][1])
+        buttons.append(InlineKeyboardButton("⬅️ နောက်သို့", callback_data=f"hist_p_{user_id}_{newest}_{page - 1}"))
+    if direction == "p" or has_more:
+        oldest = to_history_cursor(entries[-1][1])
+        buttons.append(InlineKeyboardButton("ရှေ့သို့ ➡️", callback_data=f"hist_n_{user_id}_{oldest}_{page + 1}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return msg, reply_markup
+
+async def get_user_history_stats(user_id):
+    """Get order/topup totals from MongoDB"""
+    user_id = str(user_id)
+    total_orders, total_topups = await asyncio.gather(
+        run_db(orders_collection.count_documents, {"user_id": user_id}),
+        run_db(topups_collection.count_documents, {"user_id": user_id})
+    )
+    return {"total_orders": total_orders, "total_topups": total_topups}
+
+def ensure_indexes():
+    """Create indexes for the orders, topups and sessions collections"""
+    for collection in (orders_collection, topups_collection):
+        collection.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+        # Superseded by the index above, which also orders same-millisecond entries for /history paging
+        if "user_id_1_created_at_-1" in collection.index_information():
+            collection.drop_index("user_id_1_created_at_-1")
+        collection.create_index([("user_id", ASCENDING), ("status", ASCENDING)])
+        collection.create_index([("status", ASCENDING), ("created_at", DESCENDING)])
+    ensure_unique_id_index(orders_collection, "order_id")
+    ensure_unique_id_index(topups_collection, "topup_id")
+    # Sessions are removed by MongoDB once expires_at (UTC) has passed
+    sessions_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def ensure_unique_id_index(collection, id_field):
+    """Create a unique index on an ID field, replacing an older non-unique one"""
+    index_name = f"{id_field}_1"
+    existing = collection.index_information().get(index_name)
+    if existing and existing.get("unique"):
+        return
+    if existing:
+        collection.drop_index(index_name)
+    try:
+        collection.create_index(id_field, unique=True)
+    except DuplicateKeyError as e:
+        # Legacy timestamp IDs can collide; keep lookups indexed until they're cleaned up
+        logger.warning("Duplicate %s values found, using a non-unique index: %s", id_field, e)
+        collection.create_index(id_field)
+
+async def generate_id(prefix):
+    """Generate a short collision-free ID from a block reserved on the shared counter"""
+    block = id_blocks.get(prefix)
+    if block is None or block[0] > block[1]:
+        async with id_block_lock:
+            block = id_blocks.get(prefix)
+            if block is None or block[0] > block[1]:
+                # One round trip reserves ID_BLOCK_SIZE IDs, unique across replicas
+                counter = await run_db(
+                    counters_collection.find_one_and_update,
+                    {"_id": prefix},
+                    {"$inc": {"seq": ID_BLOCK_SIZE}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                block = [counter["seq"] - ID_BLOCK_SIZE + 1, counter["seq"]]
+                id_blocks[prefix] = block
+    seq = block[0]
+    block[0] += 1
+    return f"{prefix}{seq:08d}"
+
+def parse_created_at(record):
+    """Get created_at for an embedded order/topup from its ISO timestamp"""
+    try:
+        return datetime.fromisoformat(record["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return datetime.now()
+
+def migrated_record_upsert(user_id, record, id_field, record_id):
+    """Upsert for one embedded order/topup; keyed on id + timestamp so re-running the migration doesn't duplicate"""
+    doc = {**record, id_field: record_id, "user_id": user_id, "created_at": parse_created_at(record)}
+    return UpdateOne(
+        {"user_id": user_id, id_field: record_id, "timestamp": record.get("timestamp")},
+        {"$setOnInsert": doc},
+        upsert=True
+    )
+
+def migrate_records(collection, id_field, user_id, records):
+    """Copy one user's embedded records into collection; legacy IDs taken by another record get a per-user suffix"""
+    if not records:
+        return
+    try:
+        collection.bulk_write(
+            [migrated_record_upsert(user_id, record, id_field, record.get(id_field)) for record in records],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        # Timestamp IDs (ORD%Y%m%d%H%M%S) collide across users; the suffix is stable so reruns match the same row
+        collection.bulk_write([
+            migrated_record_upsert(
+                user_id, records[error["index"]], id_field,
+                f"{records[error['index']].get(id_field)}-{user_id}-{error['index']}"
+            )
+            for error in errors
+        ], ordered=False)
+
+def migrate_embedded_history():
+    """Move embedded orders/topups arrays out of user documents (one-shot)"""
+    ensure_indexes()
+    migrated_users = 0
+    migrated_orders = 0
+    migrated_topups = 0
+    failed_users = 0
+
+    query = {"$or": [{"orders": {"$exists": True}}, {"topups": {"$exists": True}}]}
+    for user_data in users_collection.find(query, {"user_id": 1, "orders": 1, "topups": 1}):
+        user_id = str(user_data["user_id"])
+
+        try:
+            migrate_records(orders_collection, "order_id", user_id, user_data.get("orders", []))
+            migrate_records(topups_collection, "topup_id", user_id, user_data.get("topups", []))
+        except BulkWriteError as e:
+            # Keep the embedded arrays so a rerun retries this user; don't stop the others
+            logger.error("Migration failed for user %s: %s", user_id, e.details.get("writeErrors"))
+            failed_users += 1
+            continue
+
+        users_collection.update_one(
+            {"_id": user_data["_id"]},
+            {"$unset": {"orders": "", "topups": ""}}
+        )
+        migrated_users += 1
+        migrated_orders += len(user_data.get("orders", []))
+        migrated_topups += len(user_data.get("topups", []))
+
+    logger.info("Migrated %s orders and %s topups from %s users", migrated_orders, migrated_topups, migrated_users)
+    if failed_users:
+        logger.warning("%s users kept their embedded history; fix the errors above and run migrate again", failed_users)
+
+def has_pending_topup(profile):
+    """Check if user has pending topups (denormalized counter on the user document)"""
+    return bool(profile) and profile.pending_topup_count > 0
+
+def backfill_pending_topup_counters():
+    """Recompute every user's pending topup counters from the topups collection (one-shot)"""
+    users_collection.update_many({}, {"$set": {"pending_topup_count": 0, "pending_topup_amount": 0}})
+    pipeline = [
+        {"$match": {"status": "pending"}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}}
+    ]
+    requests = [
+        UpdateOne(
+            {"user_id": row["_id"]},
+            {"$set": {"pending_topup_count": row["count"], "pending_topup_amount": row["amount"]}}
+        )
+        for row in topups_collection.aggregate(pipeline)
+    ]
+    if requests:
+        users_collection.bulk_write(requests, ordered=False)
+    logger.info("Pending topup counters set for %s users with pending topups", len(requests))
+
+async def debit_and_add_order(user_id, price, order_data):
+    """Debit balance only if it covers price and add the order in one transaction; returns new balance or None"""
+    def debit_and_insert(session):
+        user_data = users_collection.find_one_and_update(
+            {"user_id": str(user_id), "balance": {"$gte": price}},
+            {"$inc": {"balance": -price}},
+            projection={"balance": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not user_data:
+            return None
+        try:
+            orders_collection.insert_one(
+                {**order_data, "user_id": str(user_id), "created_at": datetime.now()},
+                session=session
+            )
+        except Exception:
+            if session is None:
+                # No transaction to roll back: refund so a failed insert never loses the user's money
+                credit_in_session(None, user_id, {"balance": price})
+            raise
+        return user_data["balance"]
+    return await run_db(in_transaction, debit_and_insert)
+
+async def credit_user_balance(user_id, amount):
+    """Atomically add to user balance; returns new balance or None if user doesn't exist"""
+    user_data = await run_db(
+        users_collection.find_one_and_update,
         {"user_id": str(user_id)},
-        {"$set": {"balance": new_balance}}
+        {"$inc": {"balance": amount}},
+        projection={"balance": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return user_data["balance"] if user_data else None
+
+@dataclass
+class OrderJob:
+    """A persisted order waiting for its notifications"""
+    order: dict
+    user_name: str
+
+async def enqueue_order(order, user_name):
+    """Queue a persisted order for the workers; waits when the queue is full"""
+    await order_queue.put(OrderJob(order, user_name))
+    order_pipeline_stats["enqueued"] += 1
+    order_pipeline_stats["max_depth"] = max(order_pipeline_stats["max_depth"], order_queue.qsize())
+
+async def notify_new_order(bot, job):
+    """Send a new order to the admins and the admin group"""
+    order = job.order
+    user_name = job.user_name
+    order_id = order["order_id"]
+    user_id = order["user_id"]
+    game_id = order["game_id"]
+    server_id = order["server_id"]
+    amount = order["amount"]
+    price = order["price"]
+    order_time = datetime.fromisoformat(order["timestamp"]).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Create confirm/cancel buttons for admin
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Confirm", callback_data=f"order_confirm_{order_id}"),
+            InlineKeyboardButton("❌ Cancel", callback_data=f"order_cancel_{order_id}")
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # Notify admin
+    admin_msg = (
+        f"🔔 ***အော်ဒါအသစ်ရောက်ပါပြီ!***\n\n"
+        f"📝 ***Order ID:*** `{order_id}`\n"
+        f"👤 ***User Name:*** [{user_name}](tg://user?id={user_id})\n\n"
+        f"🆔 ***User ID:*** `{user_id}`\n"
+        f"🎮 ***Game ID:*** `{game_id}`\n"
+        f"🌐 ***Server ID:*** `{server_id}`\n"
+        f"💎 ***Amount:*** {amount}\n"
+        f"💰 ***Price:*** {price:,} MMK\n"
+        f"⏰ ***Time:*** {order_time}\n"
+        f"📊 Status: ⏳ ***စောင့်ဆိုင်းနေသည်***"
     )
 
+    # Send to all admins
+    admin_list = await get_admin_ids()
+    await fan_out(admin_list, lambda chat_id: bot.send_message(
+        chat_id=chat_id,
+        text=admin_msg,
+        parse_mode="Markdown",
+        reply_markup=reply_markup
+    ))
+
+    # Notify admin group; a failure here reaches order_worker, which logs and counts it
+    if await is_bot_admin_in_group(bot, ADMIN_GROUP_ID):
+        group_msg = (
+            f"🛒 ***အော်ဒါအသစ် ရောက်ပါပြီ!***\n\n"
+            f"📝 ***Order ID:*** `{order_id}`\n"
+            f"👤 ***User Name:*** [{user_name}](tg://user?id={user_id})\n"
+            f"🎮 ***Game ID:*** `{game_id}`\n"
+            f"🌐 ***Server ID:*** `{server_id}`\n"
+            f"💎 ***Amount:*** {amount}\n"
+            f"💰 ***Price:*** {price:,} MMK\n"
+            f"⏰ ***Time:*** {order_time}\n"
+            f"📊 ***Status:*** ⏳ စောင့်ဆိုင်းနေသည်\n\n"
+            f"#NewOrder #MLBB"
+        )
+        await send_with_limits(ADMIN_GROUP_ID, lambda chat_id: bot.send_message(
+            chat_id=chat_id, text=group_msg, parse_mode="Markdown"
+        ))
+
+async def order_worker(bot):
+    """Take orders off order_queue and run their downstream steps until cancelled"""
+    while True:
+        job = await order_queue.get()
+        token = bind_log_context(order_id=job.order["order_id"], user_id=job.order["user_id"])
+        try:
+            await notify_new_order(bot, job)
+            order_pipeline_stats["processed"] += 1
+        except Exception as e:
+            order_pipeline_stats["failed"] += 1
+            logger.exception("Order pipeline error: %s", e)
+        finally:
+            reset_log_context(token)
+            order_queue.task_done()
+
+def start_order_workers(bot):
+    """Start ORDER_WORKERS order workers"""
+    for _ in range(ORDER_WORKERS):
+        order_workers.append(asyncio.create_task(order_worker(bot)))
+
+async def stop_order_workers():
+    """Drain order_queue (bounded by ORDER_DRAIN_TIMEOUT), then cancel the workers"""
+    try:
+        await asyncio.wait_for(order_queue.join(), timeout=ORDER_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("%s queued orders were not notified before shutdown", order_queue.qsize())
+    for worker in order_workers:
+        worker.cancel()
+    await asyncio.gather(*order_workers, return_exceptions=True)
+    order_workers.clear()
+
+class TokenBucket:
+    """Async token bucket allowing `rate` sends per second with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def is_idle(self):
+        """Check if the bucket is full, i.e. can be dropped without losing state"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+global_send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+
+def get_chat_bucket(chat_id):
+    """Get the per-chat token bucket (groups are limited harder than private chats)"""
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(chat_buckets) >= MAX_CHAT_BUCKETS:
+            for idle_chat_id in [cid for cid, b in chat_buckets.items() if b.is_idle()]:
+                del chat_buckets[idle_chat_id]
+        if int(chat_id) < 0:
+            bucket = TokenBucket(TELEGRAM_GROUP_RATE, 1)
+        else:
+            bucket = TokenBucket(TELEGRAM_CHAT_RATE, 1)
+        chat_buckets[chat_id] = bucket
+    return bucket
+
+def request_not_sent(error):
+    """Check if a NetworkError happened before the request reached Telegram, so resending can't duplicate it"""
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+async def send_with_limits(chat_id, send, retries=SEND_RETRIES):
+    """Call send(chat_id) under the global and per-chat limits, honouring RetryAfter"""
+    for attempt in range(retries + 1):
+        await get_chat_bucket(chat_id).acquire()
+        await global_send_bucket.acquire()
+        try:
+            return await send(chat_id)
+        except RetryAfter as e:
+            if attempt == retries:
+                raise
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            await asyncio.sleep(delay)
+        except BadRequest:
+            # BadRequest subclasses NetworkError but retrying won't fix it
+            raise
+        except NetworkError as e:
+            # A read timeout or dropped connection may come after Telegram delivered the message
+            if attempt == retries or not request_not_sent(e):
+                raise
+            await asyncio.sleep(SEND_BACKOFF * (2 ** attempt))
+
+async def fan_out(chat_ids, send):
+    """Send to many chats in parallel under rate limits; returns {chat_id: message or exception}"""
+    chat_ids = list(dict.fromkeys(chat_ids))
+    results = await asyncio.gather(
+        *(send_with_limits(chat_id, send) for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    outcomes = dict(zip(chat_ids, results))
+    for chat_id, result in outcomes.items():
+        if isinstance(result, Exception):
+            logger.error("Error sending to %s: %s", chat_id, result)
+    return outcomes
+
+def order_status_message(orders, confirmed):
+    """User notification for one or more of their orders being confirmed or cancelled"""
+    if confirmed:
+        msg = "✅ ***အော်ဒါ အတည်ပြုပြီးပါပြီ!***\n\n"
+    else:
+        msg = "❌ ***အော်ဒါ ပယ်ဖျက်ခံရပါပြီ!***\n\n"
+    for order in orders:
+        msg += f"📝 `{order['order_id']}` - 💎 {order['amount']} ({order['price']:,} MMK)\n"
+    if confirmed:
+        msg += "\n💎 ***Diamonds များ ရရှိပါပြီ!***"
+    else:
+        refund = sum(order["price"] for order in orders)
+        msg += f"\n💰 ***{refund:,} MMK ကို လက်ကျန်ငွေထဲ ပြန်ထည့်ပေးပြီးပါပြီ။***\n"
+        msg += "📞 ***ပြဿနာရှိရင် admin ကို ဆက်သွယ်ပါ။***"
+    return msg
+
+def topup_approved_message(topups, balance):
+    """User notification for one or more of their topups being approved"""
+    msg = "✅ ***ငွေဖြည့်မှု အတည်ပြုပါပြီ!*** 🎉\n\n"
+    for topup in topups:
+        msg += f"💰 `{topup['amount']:,} MMK` ({topup['topup_id']})\n"
+    msg += (
+        f"💳 ***လက်ကျန်ငွေ:*** `{balance:,} MMK`\n\n"
+        "🔓 ***Bot လုပ်ဆောင်ချက်များ ပြန်လည် အသုံးပြုနိုင်ပါပြီ!***\n\n"
+        "💎 ***Order တင်ရန်:***\n"
+        "`/mmb gameid serverid amount`"
+    )
+    return msg
+
+async def notify_users(bot, messages):
+    """Send each user their own message, batched through fan_out under rate limits"""
+    return await fan_out(messages, lambda chat_id: bot.send_message(
+        chat_id=chat_id, text=messages[chat_id], parse_mode="Markdown"
+    ))
+
+def group_by_user(items):
+    """Group orders/topups by chat id of their user"""
+    grouped = {}
+    for item in items:
+        grouped.setdefault(int(item["user_id"]), []).append(item)
+    return grouped
+
+async def refresh_profile_photo(bot, user_id):
+    """Fetch the user's latest profile photo file_id into the cache"""
+    try:
+        user_photos = await bot.get_user_profile_photos(user_id=int(user_id), limit=1)
+        photo_id = user_photos.photos[0][0].file_id if user_photos.total_count > 0 else None
+        if len(profile_photo_cache) >= MAX_PROFILE_PHOTO_CACHE:
+            now = time.monotonic()
+            for expired_id in [uid for uid, entry in profile_photo_cache.items() if entry[1] <= now]:
+                del profile_photo_cache[expired_id]
+        profile_photo_cache[user_id] = (photo_id, time.monotonic() + PROFILE_PHOTO_CACHE_TTL)
+    except Exception as e:
+        logger.error("Error fetching profile photo for %s: %s", user_id, e)
+    finally:
+        profile_photo_fetches.discard(user_id)
+
+def get_profile_photo(context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Get cached profile photo file_id; on a miss return None and fetch it in the background"""
+    user_id = str(user_id)
+    entry = profile_photo_cache.get(user_id)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+    if user_id not in profile_photo_fetches:
+        profile_photo_fetches.add(user_id)
+        context.application.create_task(refresh_profile_photo(context.bot, user_id))
+    return None
+
+def forget_profile_photo(user_id):
+    """Drop a cached file_id that failed to send"""
+    profile_photo_cache.pop(str(user_id), None)
+
 def validate_game_id(game_id):
     """Validate MLBB Game ID (6-10 digits)"""
     if not game_id.isdigit():
@@ -205,28 +1436,10 @@ def is_banned_account(game_id):
 
     return False
 
-def get_price(diamonds):
-    """Get price for diamonds from MongoDB"""
-    custom_prices = get_prices()
-    if diamonds in custom_prices:
-        return custom_prices[diamonds]
-
-    # Default prices
-    if diamonds.startswith("wp") and diamonds[2:].isdigit():
-        n = int(diamonds[2:])
-        if 1 <= n <= 10:
-            return n * 6000
-            
-    price_table = {
-        "11": 950, "22": 1900, "33": 2850, "56": 4200, "112": 8200,
-        "86": 5100, "172": 10200, "257": 15300, "343": 20400,
-        "429": 25500, "514": 30600, "600": 35700, "706": 40800,
-        "878": 51000, "963": 56100, "1049": 61200, "1135": 66300,
-        "1412": 81600, "2195": 122400, "3688": 204000,
-        "5532": 306000, "9288": 510000, "12976": 714000,
-        "55": 3500, "165": 10000, "275": 16000, "565": 33000
-    }
-    return price_table.get(diamonds)
+async def get_price(diamonds):
+    """Get price for diamonds from the compiled price table"""
+    compiled = await get_compiled_prices()
+    return compiled["table"].get(diamonds)
 
 def is_payment_screenshot(update):
     """
@@ -238,17 +1451,6 @@ def is_payment_screenshot(update):
         return True
     return False
 
-async def check_pending_topup(user_id):
-    """Check if user has pending topups"""
-    user_data = get_user(user_id)
-    if not user_data:
-        return False
-        
-    for topup in user_data.get("topups", []):
-        if topup.get("status") == "pending":
-            return True
-    return False
-
 async def send_pending_topup_warning(update: Update):
     """Send pending topup warning message"""
     await update.message.reply_text(
@@ -262,10 +1464,20 @@ async def send_pending_topup_warning(update: Update):
         parse_mode="Markdown"
     )
 
-async def check_maintenance_mode(command_type):
-    """Check if specific command type is in maintenance mode"""
-    bot_maintenance = get_bot_maintenance()
-    return bot_maintenance.get(command_type, True)
+async def send_insufficient_balance_message(update: Update, price, user_balance):
+    """Send insufficient balance message"""
+    keyboard = [[InlineKeyboardButton("💳 ငွေဖြည့်မယ်", callback_data="topup_button")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await update.message.reply_text(
+        f"❌ ***လက်ကျန်ငွေ မလုံလောက်ပါ!***\n\n"
+        f"💰 ***လိုအပ်တဲ့ငွေ***: {price:,} MMK\n"
+        f"💳 ***သင့်လက်ကျန်***: {user_balance:,} MMK\n"
+        f"❗ ***လိုအပ်သေးတာ***: {price - user_balance:,} MMK\n\n"
+        "***ငွေဖြည့်ရန်*** `/topup amount` ***သုံးပါ။***",
+        parse_mode="Markdown",
+        reply_markup=reply_markup
+    )
 
 async def send_maintenance_message(update: Update, command_type):
     """Send maintenance mode message"""
@@ -336,11 +1548,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = user.username or "-"
     name = f"{user.first_name} {user.last_name or ''}".strip()
 
-    # Load authorized users
-    load_authorized_users()
+    state = context.update_state
 
     # Check if user is authorized
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [
             [InlineKeyboardButton("📝 Register တောင်းဆိုမယ်", callback_data="request_register")]
         ]
@@ -362,18 +1573,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for pending topups first
-    if await check_pending_topup(user_id):
+    if state.has_pending_topup:
         await send_pending_topup_warning(update)
         return
 
     # Get or create user
-    user_data = get_user(user_id)
-    if not user_data:
-        user_data = create_user(user_id, name, username)
+    if not state.profile:
+        state.profile = UserProfile.from_doc(await create_user(user_id, name, username))
 
     # Clear any restricted state when starting
-    if user_id in user_states:
-        del user_states[user_id]
+    if state.waiting_approval:
+        await clear_user_state(user_id)
 
     # Create clickable name
     clickable_name = f"[{name}](tg://user?id={user_id})"
@@ -395,26 +1605,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Try to send with user's profile photo
+    photo_id = get_profile_photo(context, user_id)
     try:
-        user_photos = await context.bot.get_user_profile_photos(user_id=int(user_id), limit=1)
-        if user_photos.total_count > 0:
+        if photo_id:
             await context.bot.send_photo(
                 chat_id=update.effective_chat.id,
-                photo=user_photos.photos[0][0].file_id,
+                photo=photo_id,
                 caption=msg,
                 parse_mode="Markdown"
             )
         else:
             await update.message.reply_text(msg, parse_mode="Markdown")
     except Exception as e:
+        forget_profile_photo(user_id)
         await update.message.reply_text(msg, parse_mode="Markdown")
 
 async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [[InlineKeyboardButton("👑 Contact Owner", url=f"tg://user?id={ADMIN_ID}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -425,12 +1637,12 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check maintenance mode
-    if not await check_maintenance_mode("orders"):
+    if not state.is_open("orders"):
         await send_maintenance_message(update, "orders")
         return
 
     # Check if user is restricted after screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         await update.message.reply_text(
             "⏳ ***Screenshot ပို့ပြီးပါပြီ!***\n\n"
             "❌ ***Admin က လက်ခံပြီးကြောင်း အတည်ပြုတဲ့အထိ commands တွေ အသုံးပြုလို့ မရပါ။***\n\n"
@@ -441,12 +1653,12 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for pending topups first
-    if await check_pending_topup(user_id):
+    if state.has_pending_topup:
         await send_pending_topup_warning(update)
         return
 
     # Check if user has pending topup process
-    if user_id in pending_topups:
+    if state.in_topup_process:
         await update.message.reply_text(
             "⏳ ***Topup လုပ်ငန်းစဉ် အရင်ပြီးဆုံးပါ!***\n\n"
             "❌ ***လက်ရှိ topup လုပ်ငန်းစဉ်ကို မပြီးသေးပါ။***\n\n"
@@ -533,7 +1745,7 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         return
 
-    price = get_price(amount)
+    price = await get_price(amount)
 
     if not price:
         await update.message.reply_text(
@@ -545,26 +1757,15 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    user_data = get_user(user_id)
-    user_balance = user_data.get("balance", 0) if user_data else 0
+    user_balance = state.profile.balance if state.profile else 0
 
     if user_balance < price:
-        keyboard = [[InlineKeyboardButton("💳 ငွေဖြည့်မယ်", callback_data="topup_button")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await update.message.reply_text(
-            f"❌ ***လက်ကျန်ငွေ မလုံလောက်ပါ!***\n\n"
-            f"💰 ***လိုအပ်တဲ့ငွေ***: {price:,} MMK\n"
-            f"💳 ***သင့်လက်ကျန်***: {user_balance:,} MMK\n"
-            f"❗ ***လိုအပ်သေးတာ***: {price - user_balance:,} MMK\n\n"
-            "***ငွေဖြည့်ရန်*** `/topup amount` ***သုံးပါ။***",
-            parse_mode="Markdown",
-            reply_markup=reply_markup
-        )
+        await send_insufficient_balance_message(update, price, user_balance)
         return
 
     # Process order
-    order_id = f"ORD{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    order_id = await generate_id("ORD")
+    bind_log_context(order_id=order_id)
     order = {
         "order_id": order_id,
         "game_id": game_id,
@@ -577,70 +1778,18 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "chat_id": update.effective_chat.id
     }
 
-    # Deduct balance and add order
-    new_balance = user_balance - price
-    update_user_balance(user_id, new_balance)
-    add_user_order(user_id, order)
-
-    # Create confirm/cancel buttons for admin
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirm", callback_data=f"order_confirm_{order_id}"),
-            InlineKeyboardButton("❌ Cancel", callback_data=f"order_cancel_{order_id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Deduct balance and add order atomically
+    new_balance = await debit_and_add_order(user_id, price, order)
+    if new_balance is None:
+        # Balance changed since the update started (e.g. a concurrent order)
+        user_data = await get_user(user_id, ("balance",))
+        user_balance = user_data.get("balance", 0) if user_data else 0
+        await send_insufficient_balance_message(update, price, user_balance)
+        return
 
-    # Get user name
+    # Admin and group notifications are sent by the order workers
     user_name = f"{update.effective_user.first_name} {update.effective_user.last_name or ''}".strip()
-
-    # Notify admin
-    admin_msg = (
-        f"🔔 ***အော်ဒါအသစ်ရောက်ပါပြီ!***\n\n"
-        f"📝 ***Order ID:*** `{order_id}`\n"
-        f"👤 ***User Name:*** [{user_name}](tg://user?id={user_id})\n\n"
-        f"🆔 ***User ID:*** `{user_id}`\n"
-        f"🎮 ***Game ID:*** `{game_id}`\n"
-        f"🌐 ***Server ID:*** `{server_id}`\n"
-        f"💎 ***Amount:*** {amount}\n"
-        f"💰 ***Price:*** {price:,} MMK\n"
-        f"⏰ ***Time:*** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        f"📊 Status: ⏳ ***စောင့်ဆိုင်းနေသည်***"
-    )
-
-    # Send to all admins
-    settings = settings_collection.find_one({})
-    admin_list = settings.get("admin_ids", [ADMIN_ID])
-    for admin_id in admin_list:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=admin_msg,
-                parse_mode="Markdown",
-                reply_markup=reply_markup
-            )
-        except:
-            pass
-
-    # Notify admin group
-    try:
-        bot = Bot(token=BOT_TOKEN)
-        if await is_bot_admin_in_group(bot, ADMIN_GROUP_ID):
-            group_msg = (
-                f"🛒 ***အော်ဒါအသစ် ရောက်ပါပြီ!***\n\n"
-                f"📝 ***Order ID:*** `{order_id}`\n"
-                f"👤 ***User Name:*** [{user_name}](tg://user?id={user_id})\n"
-                f"🎮 ***Game ID:*** `{game_id}`\n"
-                f"🌐 ***Server ID:*** `{server_id}`\n"
-                f"💎 ***Amount:*** {amount}\n"
-                f"💰 ***Price:*** {price:,} MMK\n"
-                f"⏰ ***Time:*** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"📊 ***Status:*** ⏳ စောင့်ဆိုင်းနေသည်\n\n"
-                f"#NewOrder #MLBB"
-            )
-            await bot.send_message(chat_id=ADMIN_GROUP_ID, text=group_msg, parse_mode="Markdown")
-    except Exception as e:
-        pass
+    await enqueue_order(order, user_name)
 
     await update.message.reply_text(
         f"✅ ***အော်ဒါ အောင်မြင်ပါပြီ!***\n\n"
@@ -659,9 +1808,10 @@ async def mmb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [[InlineKeyboardButton("👑 Contact Owner", url=f"tg://user?id={ADMIN_ID}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -672,7 +1822,7 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user is restricted after screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         await update.message.reply_text(
             "⏳ ***Screenshot ပို့ပြီးပါပြီ!***\n\n"
             "❌ ***Admin က လက်ခံပြီးကြောင်း အတည်ပြုတဲ့အထိ commands တွေ အသုံးပြုလို့ မရပါ။***\n\n"
@@ -683,7 +1833,7 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user has pending topup process
-    if user_id in pending_topups:
+    if state.in_topup_process:
         await update.message.reply_text(
             "⏳ ***Topup လုပ်ငန်းစဉ် ဆက်လက်လုပ်ဆောင်ပါ!***\n\n"
             "❌ ***လက်ရှိ topup လုပ်ငန်းစဉ်ကို မပြီးသေးပါ။***\n\n"
@@ -696,32 +1846,28 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for pending topups in data
-    if await check_pending_topup(user_id):
+    if state.has_pending_topup:
         await send_pending_topup_warning(update)
         return
 
-    user_data = get_user(user_id)
+    profile = state.profile
 
-    if not user_data:
+    if not profile:
         await update.message.reply_text("❌ အရင်ဆုံး /start နှိပ်ပါ။")
         return
 
-    balance = user_data.get("balance", 0)
-    total_orders = len(user_data.get("orders", []))
-    total_topups = len(user_data.get("topups", []))
+    balance = profile.balance
+    stats = await get_user_history_stats(user_id)
+    total_orders = stats["total_orders"]
+    total_topups = stats["total_topups"]
 
     # Check for pending topups
-    pending_topups_count = 0
-    pending_amount = 0
-
-    for topup in user_data.get("topups", []):
-        if topup.get("status") == "pending":
-            pending_topups_count += 1
-            pending_amount += topup.get("amount", 0)
+    pending_topups_count = profile.pending_topup_count
+    pending_amount = profile.pending_topup_amount
 
     # Escape special characters
-    name = user_data.get('name', 'Unknown').replace('*', '').replace('_', '').replace('`', '').replace('[', '').replace(']', '')
-    username = user_data.get('username', 'None').replace('*', '').replace('_', '').replace('`', '').replace('[', '').replace(']', '')
+    name = profile.name.replace('*', '').replace('_', '').replace('`', '').replace('[', '').replace(']', '')
+    username = profile.username.replace('*', '').replace('_', '').replace('`', '').replace('[', '').replace(']', '')
 
     status_msg = ""
     if pending_topups_count > 0:
@@ -741,12 +1887,12 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Try to get user's profile photo
+    photo_id = get_profile_photo(context, user_id)
     try:
-        user_photos = await context.bot.get_user_profile_photos(user_id=int(user_id), limit=1)
-        if user_photos.total_count > 0:
+        if photo_id:
             await context.bot.send_photo(
                 chat_id=update.effective_chat.id,
-                photo=user_photos.photos[0][0].file_id,
+                photo=photo_id,
                 caption=balance_text,
                 parse_mode="Markdown",
                 reply_markup=reply_markup
@@ -758,6 +1904,7 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=reply_markup
             )
     except:
+        forget_profile_photo(user_id)
         await update.message.reply_text(
             balance_text,
             parse_mode="Markdown",
@@ -767,9 +1914,10 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def topup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [[InlineKeyboardButton("👑 Contact Owner", url=f"tg://user?id={ADMIN_ID}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -780,12 +1928,12 @@ async def topup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check maintenance mode
-    if not await check_maintenance_mode("topups"):
+    if not state.is_open("topups"):
         await send_maintenance_message(update, "topups")
         return
 
     # Check if user is restricted after screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         await update.message.reply_text(
             "⏳ ***Screenshot ပို့ပြီးပါပြီ!***\n\n"
             "❌ ***Admin က လက်ခံပြီးကြောင်း အတည်ပြုတဲ့အထိ commands တွေ အသုံးပြုလို့ မရပါ။***\n\n"
@@ -796,12 +1944,12 @@ async def topup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for pending topups first
-    if await check_pending_topup(user_id):
+    if state.has_pending_topup:
         await send_pending_topup_warning(update)
         return
 
     # Check if user has pending topup process
-    if user_id in pending_topups:
+    if state.in_topup_process:
         await update.message.reply_text(
             "⏳ ***Topup လုပ်ငန်းစဉ် ဆက်လက်လုပ်ဆောင်ပါ!***\n\n"
             "❌ ***လက်ရှိ topup လုပ်ငန်းစဉ်ကို မပြီးသေးပါ။***\n\n"
@@ -846,10 +1994,10 @@ async def topup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Store pending topup
-    pending_topups[user_id] = {
+    await set_pending_topup(user_id, {
         "amount": amount,
         "timestamp": datetime.now().isoformat()
-    }
+    })
 
     # Show payment method selection
     keyboard = [
@@ -869,12 +2017,79 @@ async def topup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+def render_price_message(table, custom_prices):
+    """Build the /price message from the compiled price table"""
+    price_msg = "💎 ***MLBB Diamond ဈေးနှုန်းများ***\n\n"
+
+    # Weekly Pass section
+    price_msg += "🎟️ ***Weekly Pass***:\n"
+    for wp_key in WEEKLY_PASS_PRICES:
+        price_msg += f"• {wp_key} = {table[wp_key]:,} MMK\n"
+    price_msg += "\n"
+
+    # Regular Diamonds section
+    price_msg += "💎 ***Regular Diamonds***:\n"
+    for diamond in REGULAR_DIAMOND_PRICES:
+        price_msg += f"• {diamond} = {table[diamond]:,} MMK\n"
+    price_msg += "\n"
+
+    # 2X Diamond Pass section
+    price_msg += "💎 ***2X Diamond Pass***:\n"
+    for dp in DOUBLE_PASS_PRICES:
+        price_msg += f"• {dp} = {table[dp]:,} MMK\n"
+    price_msg += "\n"
+
+    # Show any other custom items not in default categories
+    other_customs = {k: v for k, v in custom_prices.items()
+                    if k not in DEFAULT_PRICES}
+    if other_customs:
+        price_msg += "🔥 ***Special Items***:\n"
+        for item, price in other_customs.items():
+            price_msg += f"• {item} = {price:,} MMK\n"
+        price_msg += "\n"
+
+    price_msg += (
+        "***📝 အသုံးပြုနည်း***:\n"
+        "`/mmb gameid serverid amount`\n\n"
+        "***ဥပမာ***:\n"
+        "`/mmb 123456789 12345 wp1`\n"
+        "`/mmb 123456789 12345 86`"
+    )
+
+    return price_msg
+
+def compile_prices(custom_prices):
+    """Merge defaults and custom overrides into a lookup table and pre-rendered /price message"""
+    table = {**DEFAULT_PRICES, **custom_prices}
+    return {
+        "prices": custom_prices,
+        "table": table,
+        "message": render_price_message(table, custom_prices)
+    }
+
+async def get_compiled_prices():
+    """Get the compiled prices, rebuilt only when the custom prices change"""
+    global compiled_prices
+    custom_prices = await get_prices()
+    compiled = compiled_prices
+    # Same snapshot from the settings cache: nothing to compare
+    if compiled is None or compiled["prices"] is not custom_prices:
+        # A TTL refresh hands out a new but usually equal dict; only recompile on a real change
+        if compiled is None or compiled["prices"] != custom_prices:
+            compiled = compile_prices(custom_prices)
+        else:
+            compiled = {**compiled, "prices": custom_prices}
+        # Swapped in with one assignment so readers never see a half-built table
+        compiled_prices = compiled
+    return compiled
+
 async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [[InlineKeyboardButton("👑 Contact Owner", url=f"tg://user?id={ADMIN_ID}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -885,7 +2100,7 @@ async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user is restricted after screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         await update.message.reply_text(
             "⏳ ***Screenshot ပို့ပြီးပါပြီ!***\n\n"
             "❌ ***Admin က လက်ခံပြီးကြောင်း အတည်ပြုတဲ့အထိ commands တွေ အသုံးပြုလို့ မရပါ။***\n\n"
@@ -896,7 +2111,7 @@ async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user has pending topup process
-    if user_id in pending_topups:
+    if state.in_topup_process:
         await update.message.reply_text(
             "⏳ ***Topup လုပ်ငန်းစဉ် ဆက်လက်လုပ်ဆောင်ပါ!***\n\n"
             "❌ ***လက်ရှိ topup လုပ်ငန်းစဉ်ကို မပြီးသေးပါ။***\n\n"
@@ -908,86 +2123,21 @@ async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Get custom prices
-    custom_prices = get_prices()
-
-    # Default prices
-    default_prices = {
-        # Weekly Pass
-        "wp1": 6000, "wp2": 12000, "wp3": 18000, "wp4": 24000, "wp5": 30000,
-        "wp6": 36000, "wp7": 42000, "wp8": 48000, "wp9": 54000, "wp10": 60000,
-        # Regular Diamonds
-        "11": 950, "22": 1900, "33": 2850, "56": 4200, "86": 5100, "112": 8200,
-        "172": 10200, "257": 15300, "343": 20400, "429": 25500, "514": 30600,
-        "600": 35700, "706": 40800, "878": 51000, "963": 56100, "1049": 61200,
-        "1135": 66300, "1412": 81600, "2195": 122400, "3688": 204000,
-        "5532": 306000, "9288": 510000, "12976": 714000,
-        # 2X Diamond Pass
-        "55": 3500, "165": 10000, "275": 16000, "565": 33000
-    }
-
-    # Merge custom prices with defaults
-    current_prices = {**default_prices, **custom_prices}
-
-    price_msg = "💎 ***MLBB Diamond ဈေးနှုန်းများ***\n\n"
-
-    # Weekly Pass section
-    price_msg += "🎟️ ***Weekly Pass***:\n"
-    for i in range(1, 11):
-        wp_key = f"wp{i}"
-        if wp_key in current_prices:
-            price_msg += f"• {wp_key} = {current_prices[wp_key]:,} MMK\n"
-    price_msg += "\n"
-
-    # Regular Diamonds section
-    price_msg += "💎 ***Regular Diamonds***:\n"
-    regular_diamonds = ["11", "22", "33", "56", "86", "112", "172", "257", "343",
-                       "429", "514", "600", "706", "878", "963", "1049", "1135",
-                       "1412", "2195", "3688", "5532", "9288", "12976"]
-
-    for diamond in regular_diamonds:
-        if diamond in current_prices:
-            price_msg += f"• {diamond} = {current_prices[diamond]:,} MMK\n"
-    price_msg += "\n"
-
-    # 2X Diamond Pass section
-    price_msg += "💎 ***2X Diamond Pass***:\n"
-    double_pass = ["55", "165", "275", "565"]
-    for dp in double_pass:
-        if dp in current_prices:
-            price_msg += f"• {dp} = {current_prices[dp]:,} MMK\n"
-    price_msg += "\n"
-
-    # Show any other custom items not in default categories
-    other_customs = {k: v for k, v in custom_prices.items()
-                    if k not in default_prices}
-    if other_customs:
-        price_msg += "🔥 ***Special Items***:\n"
-        for item, price in other_customs.items():
-            price_msg += f"• {item} = {price:,} MMK\n"
-        price_msg += "\n"
-
-    price_msg += (
-        "***📝 အသုံးပြုနည်း***:\n"
-        "`/mmb gameid serverid amount`\n\n"
-        "***ဥပမာ***:\n"
-        "`/mmb 123456789 12345 wp1`\n"
-        "`/mmb 123456789 12345 86`"
-    )
-
+    price_msg = (await get_compiled_prices())["message"]
     await update.message.reply_text(price_msg, parse_mode="Markdown")
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         return
 
     # Clear pending topup if exists
-    if user_id in pending_topups:
-        del pending_topups[user_id]
+    if await get_pending_topup(user_id, fresh=True):
+        await clear_pending_topup(user_id)
         await update.message.reply_text(
             "✅ ***ငွေဖြည့်ခြင်း ပယ်ဖျက်ပါပြီ!***\n\n"
             "💡 ***ပြန်ဖြည့်ချင်ရင်*** /topup ***နှိပ်ပါ။***",
@@ -1003,9 +2153,10 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check authorization
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         keyboard = [[InlineKeyboardButton("👑 Contact Owner", url=f"tg://user?id={ADMIN_ID}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -1016,7 +2167,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user is restricted after screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         await update.message.reply_text(
             "⏳ ***Screenshot ပို့ပြီးပါပြီ!***\n\n"
             "❌ ***Admin က လက်ခံပြီးကြောင်း အတည်ပြုတဲ့အထိ commands တွေ အသုံးပြုလို့ မရပါ။***\n\n"
@@ -1027,7 +2178,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user has pending topup process
-    if user_id in pending_topups:
+    if state.in_topup_process:
         await update.message.reply_text(
             "⏳ ***Topup လုပ်ငန်းစဉ် ဆက်လက်လုပ်ဆောင်ပါ!***\n\n"
             "❌ ***လက်ရှိ topup လုပ်ငန်းစဉ်ကို မပြီးသေးပါ။***\n\n"
@@ -1040,93 +2191,66 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for pending topups in data
-    if await check_pending_topup(user_id):
+    if state.has_pending_topup:
         await send_pending_topup_warning(update)
         return
 
-    user_data = get_user(user_id)
-
-    if not user_data:
+    if not state.profile:
         await update.message.reply_text("❌ အရင်ဆုံး /start နှိပ်ပါ။")
         return
 
-    orders = user_data.get("orders", [])
-    topups = user_data.get("topups", [])
-
-    if not orders and not topups:
+    history_page = await render_history_page(user_id)
+    if not history_page:
         await update.message.reply_text("📋 သင့်မှာ မည်သည့် မှတ်တမ်းမှ မရှိသေးပါ။")
         return
 
-    msg = "📋 သင့်ရဲ့ မှတ်တမ်းများ\n\n"
-
-    if orders:
-        msg += "🛒 အော်ဒါများ (နောက်ဆုံး 5 ခု):\n"
-        for order in orders[-5:]:
-            status_emoji = "✅" if order.get("status") == "completed" else "⏳"
-            msg += f"{status_emoji} {order['order_id']} - {order['amount']} ({order['price']:,} MMK)\n"
-        msg += "\n"
-
-    if topups:
-        msg += "💳 ငွေဖြည့်များ (နောက်ဆုံး 5 ခု):\n"
-        for topup in topups[-5:]:
-            status_emoji = "✅" if topup.get("status") == "approved" else "⏳"
-            msg += f"{status_emoji} {topup['amount']:,} MMK - {topup.get('timestamp', 'Unknown')[:10]}\n"
-
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    msg, reply_markup = history_page
+    await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=reply_markup)
 
 async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
     # Check if user is any admin
-    if not is_admin(user_id):
+    if not context.update_state.is_admin:
         await update.message.reply_text("❌ သင်သည် admin မဟုတ်ပါ!")
         return
 
     args = context.args
-    if len(args) != 2:
+    if len(args) not in (1, 2):
         await update.message.reply_text(
             "❌ အမှားရှိပါတယ်!\n\n"
-            "မှန်ကန်တဲ့ format: `/approve user_id amount`\n"
-            "ဥပမာ: `/approve 123456789 50000`"
+            "မှန်ကန်တဲ့ format: `/approve topup_id` သို့မဟုတ် `/approve user_id amount`\n"
+            "ဥပမာ: `/approve TOP00000123`, `/approve 123456789 50000`"
         )
         return
 
-    try:
-        target_user_id = args[0]
-        amount = int(args[1])
-    except ValueError:
-        await update.message.reply_text("❌ ငွေပမာဏမှားနေပါတယ်!")
-        return
+    if len(args) == 1:
+        # Approve exactly this topup; the status guard makes a second approval a no-op
+        topup, new_balance = await approve_topup(args[0], update.effective_user.first_name)
+        if not topup:
+            await update.message.reply_text("❌ Topup မတွေ့ရှိပါ သို့မဟုတ် လုပ်ဆောင်ပြီးပါပြီ!")
+            return
+        target_user_id = topup["user_id"]
+        amount = topup["amount"]
+    else:
+        try:
+            target_user_id = args[0]
+            amount = int(args[1])
+        except ValueError:
+            await update.message.reply_text("❌ ငွေပမာဏမှားနေပါတယ်!")
+            return
 
-    user_data = get_user(target_user_id)
+        # Approve and credit the matching topup; manual credits may have none
+        topup, new_balance = await approve_latest_pending_topup(target_user_id, amount, update.effective_user.first_name)
+        if not topup:
+            new_balance = await credit_user_balance(target_user_id, amount)
 
-    if not user_data:
+    if new_balance is None:
         await update.message.reply_text("❌ User မတွေ့ရှိပါ!")
         return
 
-    # Add balance to user
-    current_balance = user_data.get("balance", 0)
-    new_balance = current_balance + amount
-    update_user_balance(target_user_id, new_balance)
-
-    # Update topup status
-    topups = user_data.get("topups", [])
-    for topup in reversed(topups):
-        if topup["status"] == "pending" and topup["amount"] == amount:
-            topup["status"] = "approved"
-            topup["approved_by"] = update.effective_user.first_name
-            topup["approved_at"] = datetime.now().isoformat()
-            break
-
-    # Save updated topups
-    users_collection.update_one(
-        {"user_id": target_user_id},
-        {"$set": {"topups": topups}}
-    )
-
     # Clear user restriction state after approval
-    if target_user_id in user_states:
-        del user_states[target_user_id]
+    await clear_user_state(target_user_id)
 
     # Notify user
     try:
@@ -1163,6 +2287,85 @@ async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+def parse_bulk_ids(args):
+    """Split /command arguments into unique IDs, accepting spaces or commas"""
+    ids = [part.strip().upper() for arg in args for part in arg.split(",")]
+    return list(dict.fromkeys(part for part in ids if part))
+
+def bulk_summary(title, ids, done_ids):
+    """Per-item result summary for a bulk admin command"""
+    msg = f"{title}\n\n✅ ***{len(done_ids)}/{len(ids)} ခု အောင်မြင်ပါပြီ။***\n\n"
+    for item_id in ids:
+        if item_id in done_ids:
+            msg += f"✅ `{item_id}`\n"
+        else:
+            msg += f"⚠️ `{item_id}` - မတွေ့ရှိပါ သို့မဟုတ် လုပ်ဆောင်ပြီးပါပြီ\n"
+    return msg
+
+async def run_bulk_command(update, context, usage, action):
+    """Shared admin check and ID parsing for the bulk commands; action(ids, admin_name) does the work"""
+    if not context.update_state.is_admin:
+        await update.message.reply_text("❌ သင်သည် admin မဟုတ်ပါ!")
+        return
+
+    ids = parse_bulk_ids(context.args)
+    if not ids:
+        await update.message.reply_text(usage, parse_mode="Markdown")
+        return
+    if len(ids) > BULK_ACTION_LIMIT:
+        await update.message.reply_text(f"❌ တစ်ကြိမ်လျှင် ID {BULK_ACTION_LIMIT} ခုထိသာ လုပ်ဆောင်နိုင်ပါတယ်!")
+        return
+
+    await action(ids, update.effective_user.first_name or "Admin")
+
+async def confirm_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def action(order_ids, admin_name):
+        orders = await bulk_confirm_orders(order_ids, admin_name)
+        done_ids = {order["order_id"] for order in orders}
+        await update.message.reply_text(bulk_summary("✅ ***Orders Confirm***", order_ids, done_ids), parse_mode="Markdown")
+        await notify_users(context.bot, {
+            chat_id: order_status_message(user_orders, confirmed=True)
+            for chat_id, user_orders in group_by_user(orders).items()
+        })
+
+    await run_bulk_command(
+        update, context,
+        "❌ အမှားရှိပါတယ်!\n\nမှန်ကန်တဲ့ format: `/confirmorders ORD00000001 ORD00000002 ...`",
+        action
+    )
+
+async def cancel_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def action(order_ids, admin_name):
+        orders = await bulk_cancel_orders(order_ids, admin_name)
+        done_ids = {order["order_id"] for order in orders}
+        await update.message.reply_text(bulk_summary("❌ ***Orders Cancel***", order_ids, done_ids), parse_mode="Markdown")
+        await notify_users(context.bot, {
+            chat_id: order_status_message(user_orders, confirmed=False)
+            for chat_id, user_orders in group_by_user(orders).items()
+        })
+
+    await run_bulk_command(
+        update, context,
+        "❌ အမှားရှိပါတယ်!\n\nမှန်ကန်တဲ့ format: `/cancelorders ORD00000001 ORD00000002 ...`",
+        action
+    )
+
+async def approve_topups_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def action(topup_ids, admin_name):
+        topups, balances = await bulk_approve_topups(topup_ids, admin_name)
+        done_ids = {topup["topup_id"] for topup in topups}
+        await update.message.reply_text(bulk_summary("💳 ***Topups Approve***", topup_ids, done_ids), parse_mode="Markdown")
+        await notify_users(context.bot, {
+            chat_id: topup_approved_message(user_topups, balances.get(str(chat_id), 0))
+            for chat_id, user_topups in group_by_user(topups).items()
+        })
+
+    await run_bulk_command(
+        update, context,
+        "❌ အမှားရှိပါတယ်!\n\nမှန်ကန်တဲ့ format: `/approvetopups TOP00000001 TOP00000002 ...`",
+        action
+    )
+
 async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User registration request"""
     user_id = str(update.effective_user.id)
@@ -1170,11 +2373,8 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = user.username or "-"
     name = f"{user.first_name} {user.last_name or ''}".strip()
 
-    # Load authorized users
-    load_authorized_users()
-
     # Check if already authorized
-    if is_user_authorized(user_id):
+    if context.update_state.is_authorized:
         await update.message.reply_text(
             "✅ သင်သည် အသုံးပြုခွင့် ရပြီးသား ဖြစ်ပါတယ်!\n\n"
             "🚀 /start နှိပ်ပြီး bot ကို အသုံးပြုနိုင်ပါပြီ။",
@@ -1208,12 +2408,12 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Send to owner with user's profile photo
+        photo_id = get_profile_photo(context, user_id)
         try:
-            user_photos = await context.bot.get_user_profile_photos(user_id=int(user_id), limit=1)
-            if user_photos.total_count > 0:
+            if photo_id:
                 await context.bot.send_photo(
                     chat_id=ADMIN_ID,
-                    photo=user_photos.photos[0][0].file_id,
+                    photo=photo_id,
                     caption=owner_msg,
                     parse_mode="Markdown",
                     reply_markup=reply_markup
@@ -1233,14 +2433,14 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=reply_markup
             )
     except Exception as e:
-        print(f"Error sending registration request to owner: {e}")
+        logger.error("Error sending registration request to owner: %s", e)
 
     # Send confirmation to user with their profile photo
+    photo_id = get_profile_photo(context, user_id)
     try:
-        user_photos = await context.bot.get_user_profile_photos(user_id=int(user_id), limit=1)
-        if user_photos.total_count > 0:
+        if photo_id:
             await update.message.reply_photo(
-                photo=user_photos.photos[0][0].file_id,
+                photo=photo_id,
                 caption=user_confirm_msg,
                 parse_mode="Markdown"
             )
@@ -1252,9 +2452,10 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check if user is authorized
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         return
 
     # Validate if it's a payment screenshot
@@ -1268,7 +2469,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if user_id not in pending_topups:
+    # Read through to MongoDB: the topup may have been started on another replica
+    pending = await get_pending_topup(user_id, fresh=True)
+    if not pending:
         await update.message.reply_text(
             "❌ ***Topup process မရှိပါ!***\n\n"
             "🔄 ***အရင်ဆုံး `/topup amount` command ကို သုံးပါ။***\n"
@@ -1277,7 +2480,6 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    pending = pending_topups[user_id]
     amount = pending["amount"]
     payment_method = pending.get("payment_method", "Unknown")
 
@@ -1295,10 +2497,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Set user state to restricted
-    user_states[user_id] = "waiting_approval"
+    await set_user_state(user_id, "waiting_approval")
 
     # Generate unique topup ID
-    topup_id = f"TOP{datetime.now().strftime('%Y%m%d%H%M%S')}{user_id[-4:]}"
+    topup_id = await generate_id("TOP")
+    bind_log_context(topup_id=topup_id)
 
     # Get user name
     user_name = f"{update.effective_user.first_name} {update.effective_user.last_name or ''}".strip()
@@ -1331,25 +2534,20 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "status": "pending",
         "timestamp": datetime.now().isoformat()
     }
-    add_user_topup(user_id, topup_request)
+    await add_user_topup(user_id, topup_request)
 
     # Get all admins
-    settings = settings_collection.find_one({})
-    admin_list = settings.get("admin_ids", [ADMIN_ID])
+    admin_list = await get_admin_ids()
 
     try:
         # Send to all admins
-        for admin_id in admin_list:
-            try:
-                await context.bot.send_photo(
-                    chat_id=admin_id,
-                    photo=update.message.photo[-1].file_id,
-                    caption=admin_msg,
-                    parse_mode="Markdown",
-                    reply_markup=reply_markup
-                )
-            except:
-                pass
+        await fan_out(admin_list, lambda chat_id: context.bot.send_photo(
+            chat_id=chat_id,
+            photo=update.message.photo[-1].file_id,
+            caption=admin_msg,
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        ))
 
         # Send to admin group
         try:
@@ -1363,22 +2561,22 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"🔖 ***Topup ID:*** `{topup_id}`\n"
                     f"⏰ ***Time:*** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
                     f"📊 ***Status:*** ⏳ စောင့်ဆိုင်းနေသည်\n\n"
-                    f"***Approve လုပ်ရန်:*** `/approve {user_id} {amount}`\n\n"
+                    f"***Approve လုပ်ရန်:*** `/approve {topup_id}`\n\n"
                     f"#TopupRequest #Payment"
                 )
-                await context.bot.send_photo(
-                    chat_id=ADMIN_GROUP_ID,
+                await send_with_limits(ADMIN_GROUP_ID, lambda chat_id: context.bot.send_photo(
+                    chat_id=chat_id,
                     photo=update.message.photo[-1].file_id,
                     caption=group_msg,
                     parse_mode="Markdown",
                     reply_markup=reply_markup
-                )
+                ))
         except Exception as e:
             pass
     except Exception as e:
-        print(f"Error in topup process: {e}")
+        logger.exception("Error in topup process: %s", e)
 
-    del pending_topups[user_id]
+    await clear_pending_topup(user_id)
 
     await update.message.reply_text(
         f"✅ ***Screenshot လက်ခံပါပြီ!***\n\n"
@@ -1399,9 +2597,10 @@ async def handle_restricted_content(update: Update, context: ContextTypes.DEFAUL
     """Handle all non-command messages for restricted users"""
     user_id = str(update.effective_user.id)
 
+    state = context.update_state
+
     # Check if user is authorized first
-    load_authorized_users()
-    if not is_user_authorized(user_id):
+    if not state.is_authorized:
         # For unauthorized users, give AI reply
         if update.message.text:
             reply = simple_reply(update.message.text)
@@ -1409,7 +2608,7 @@ async def handle_restricted_content(update: Update, context: ContextTypes.DEFAUL
         return
 
     # Check if user is restricted after sending screenshot
-    if user_id in user_states and user_states[user_id] == "waiting_approval":
+    if state.waiting_approval:
         # Block everything except photos for restricted users
         if update.message.photo:
             await handle_photo(update, context)
@@ -1458,10 +2657,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amount = int(parts[3])
 
         # Update pending topup with payment method
-        if user_id in pending_topups:
-            pending_topups[user_id]["payment_method"] = payment_method
+        pending = await get_pending_topup(user_id, fresh=True)
+        if pending:
+            await set_pending_topup(user_id, {**pending, "payment_method": payment_method})
 
-        payment_info = get_payment_info()
+        payment_info = await get_payment_info()
         payment_name = "KBZ Pay" if payment_method == "kpay" else "Wave Money"
         payment_num = payment_info['kpay_number'] if payment_method == "kpay" else payment_info['wave_number']
         payment_acc_name = payment_info['kpay_name'] if payment_method == "kpay" else payment_info['wave_name']
@@ -1505,11 +2705,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         username = user.username or "-"
         name = f"{user.first_name} {user.last_name or ''}".strip()
 
-        # Load authorized users
-        load_authorized_users()
-
         # Check if already authorized
-        if is_user_authorized(user_id):
+        if context.update_state.is_authorized:
             await query.answer("✅ သင်သည် အသုံးပြုခွင့် ရပြီးသား ဖြစ်ပါတယ်!", show_alert=True)
             return
 
@@ -1531,12 +2728,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         try:
             # Try to send user's profile photo first
+            photo_id = get_profile_photo(context, user_id)
             try:
-                user_photos = await context.bot.get_user_profile_photos(user_id=int(user_id), limit=1)
-                if user_photos.total_count > 0:
+                if photo_id:
                     await context.bot.send_photo(
                         chat_id=ADMIN_ID,
-                        photo=user_photos.photos[0][0].file_id,
+                        photo=photo_id,
                         caption=owner_msg,
                         parse_mode="Markdown",
                         reply_markup=reply_markup
@@ -1556,7 +2753,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=reply_markup
                 )
         except Exception as e:
-            print(f"Error sending registration request to owner: {e}")
+            logger.error("Error sending registration request to owner: %s", e)
 
         await query.answer("✅ Registration တောင်းဆိုမှု ပို့ပြီးပါပြီ!", show_alert=True)
         try:
@@ -1573,23 +2770,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Handle registration approve (admins can approve)
     elif query.data.startswith("register_approve_"):
-        if not is_admin(user_id):
+        if not context.update_state.is_admin:
             await query.answer("❌ Admin များသာ registration approve လုပ်နိုင်ပါတယ်!", show_alert=True)
             return
 
         target_user_id = query.data.replace("register_approve_", "")
-        load_authorized_users()
 
-        if target_user_id in AUTHORIZED_USERS:
+        if not await authorize_user(target_user_id):
             await query.answer("ℹ️ User ကို approve လုပ်ပြီးပါပြီ!", show_alert=True)
             return
 
-        AUTHORIZED_USERS.add(target_user_id)
-        save_authorized_users()
-
         # Clear any restrictions
-        if target_user_id in user_states:
-            del user_states[target_user_id]
+        await clear_user_state(target_user_id)
 
         # Remove buttons
         await query.edit_message_reply_markup(reply_markup=None)
@@ -1605,9 +2797,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Notify user
         try:
-            user_data = get_user(target_user_id)
-            user_name = user_data.get('name', 'User') if user_data else 'User'
-
             await context.bot.send_message(
                 chat_id=int(target_user_id),
                 text=f"🎉 Registration Approved!\n\n"
@@ -1622,7 +2811,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Handle registration reject (admins can reject)
     elif query.data.startswith("register_reject_"):
-        if not is_admin(user_id):
+        if not context.update_state.is_admin:
             await query.answer("❌ Admin များသာ registration reject လုပ်နိုင်ပါတယ်!", show_alert=True)
             return
 
@@ -1656,8 +2845,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Handle topup cancel
     elif query.data == "topup_cancel":
-        if user_id in pending_topups:
-            del pending_topups[user_id]
+        await clear_pending_topup(user_id)
 
         await query.edit_message_text(
             "✅ ***ငွေဖြည့်ခြင်း ပယ်ဖျက်ပါပြီ!***\n\n"
@@ -1668,47 +2856,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Handle topup approve
     elif query.data.startswith("topup_approve_"):
-        if not is_admin(user_id):
+        if not context.update_state.is_admin:
             await query.answer("❌ ***သင်သည် admin မဟုတ်ပါ!***")
             return
 
         topup_id = query.data.replace("topup_approve_", "")
+        bind_log_context(topup_id=topup_id)
 
-        # Find user with this topup
-        user_data = users_collection.find_one({"topups.topup_id": topup_id})
-        if not user_data:
-            await query.answer("❌ Topup မတွေ့ရှိပါ!")
-            return
-
-        # Find and approve topup
-        topup_found = False
-        topup_amount = 0
-        target_user_id = user_data["user_id"]
-
-        for topup in user_data.get("topups", []):
-            if topup.get("topup_id") == topup_id and topup.get("status") == "pending":
-                topup["status"] = "approved"
-                topup["approved_by"] = admin_name
-                topup["approved_at"] = datetime.now().isoformat()
-                topup_amount = topup["amount"]
-                topup_found = True
-
-                # Add balance to user
-                current_balance = user_data.get("balance", 0)
-                new_balance = current_balance + topup_amount
-                update_user_balance(target_user_id, new_balance)
-
-                # Clear user restriction
-                if target_user_id in user_states:
-                    del user_states[target_user_id]
-                break
+        # Approve and credit the topup; only one admin can move it out of pending
+        topup, new_balance = await approve_topup(topup_id, admin_name)
+        topup_found = topup is not None
 
         if topup_found:
-            # Save updated topups
-            users_collection.update_one(
-                {"user_id": target_user_id},
-                {"$set": {"topups": user_data["topups"]}}
-            )
+            topup_amount = topup["amount"]
+            target_user_id = topup["user_id"]
+
+            # Clear user restriction
+            await clear_user_state(target_user_id)
 
             # Remove buttons
             await query.edit_message_reply_markup(reply_markup=None)
@@ -1761,12 +2925,114 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Topup မတွေ့ရှိပါ သို့မဟုတ် လုပ်ဆောင်ပြီးပါပြီ!")
         return
 
-    # Handle order confirm/cancel (similar logic as before but with MongoDB)
-    # ... (order confirmation/cancellation logic would go here)
+    # Handle order confirm/cancel from the new-order notification
+    elif query.data.startswith("order_confirm_") or query.data.startswith("order_cancel_"):
+        if not context.update_state.is_admin:
+            await query.answer("❌ ***သင်သည် admin မဟုတ်ပါ!***")
+            return
+
+        confirmed = query.data.startswith("order_confirm_")
+        order_id = query.data.replace("order_confirm_" if confirmed else "order_cancel_", "")
+        bind_log_context(order_id=order_id)
+        if confirmed:
+            order = await confirm_order(order_id, admin_name)
+        else:
+            order = await cancel_order(order_id, admin_name)
+
+        if not order:
+            await query.answer("❌ Order မတွေ့ရှိပါ သို့မဟုတ် လုပ်ဆောင်ပြီးပါပြီ!")
+            return
+
+        # Remove buttons and record who handled it
+        try:
+            status_text = f"✅ Confirmed by: {admin_name}" if confirmed else f"❌ Cancelled by: {admin_name}"
+            await query.edit_message_text(
+                text=(query.message.text or "") + f"\n\n{status_text}",
+                reply_markup=None
+            )
+        except:
+            pass
+
+        # Notify user
+        try:
+            await send_with_limits(int(order["user_id"]), lambda chat_id: context.bot.send_message(
+                chat_id=chat_id, text=order_status_message([order], confirmed), parse_mode="Markdown"
+            ))
+        except Exception as e:
+            logger.error("Error notifying user %s: %s", order["user_id"], e)
+
+        await query.answer("✅ Order confirmed!" if confirmed else "❌ Order cancelled!", show_alert=True)
+        return
+
+    # Handle topup reject
+    elif query.data.startswith("topup_reject_"):
+        if not context.update_state.is_admin:
+            await query.answer("❌ ***သင်သည် admin မဟုတ်ပါ!***")
+            return
+
+        topup_id = query.data.replace("topup_reject_", "")
+        bind_log_context(topup_id=topup_id)
+
+        # Reject topup; only one admin can move it out of pending
+        topup = await reject_topup(topup_id, admin_name)
+        if not topup:
+            await query.answer("❌ Topup မတွေ့ရှိပါ သို့မဟုတ် လုပ်ဆောင်ပြီးပါပြီ!")
+            return
+
+        target_user_id = topup["user_id"]
+
+        # Clear user restriction
+        await clear_user_state(target_user_id)
+
+        # Remove buttons
+        await query.edit_message_reply_markup(reply_markup=None)
+
+        # Update message
+        try:
+            original_text = query.message.text or query.message.caption or ""
+            updated_text = original_text + f"\n\n❌ Rejected by: {admin_name}"
+
+            if query.message.text:
+                await query.edit_message_text(text=updated_text, parse_mode="Markdown")
+            elif query.message.caption:
+                await query.edit_message_caption(caption=updated_text, parse_mode="Markdown")
+        except:
+            pass
+
+        # Notify user
+        try:
+            await context.bot.send_message(
+                chat_id=int(target_user_id),
+                text=f"❌ ***ငွေဖြည့်မှု ငြင်းပယ်ခံရပါတယ်!***\n\n"
+                     f"💰 ***ပမာဏ:*** `{topup['amount']:,} MMK`\n"
+                     f"🔖 ***Topup ID:*** `{topup_id}`\n\n"
+                     f"🔓 ***Bot လုပ်ဆောင်ချက်များ ပြန်လည် အသုံးပြုနိုင်ပါပြီ!***\n"
+                     f"📞 ***အကြောင်းရင်း သိရှိရန် admin ကို ဆက်သွယ်ပါ။***",
+                parse_mode="Markdown"
+            )
+        except:
+            pass
+
+        await query.answer("❌ Topup rejected!", show_alert=True)
+        return
 
     # Handle other button callbacks
+    elif query.data.startswith("hist_"):
+        _, direction, owner_id, cursor, page = query.data.split("_")
+
+        # Pages are only for the user who ran /history
+        if owner_id != user_id or not context.update_state.is_authorized:
+            await query.answer("❌ ဒီမှတ်တမ်းကို ကြည့်ခွင့် မရှိပါ!", show_alert=True)
+            return
+
+        await query.answer()
+        history_page = await render_history_page(user_id, int(page), direction, cursor)
+        if history_page:
+            msg, reply_markup = history_page
+            await query.edit_message_text(msg, parse_mode="Markdown", reply_markup=reply_markup)
+
     elif query.data == "topup_button":
-        payment_info = get_payment_info()
+        payment_info = await get_payment_info()
         try:
             keyboard = [
                 [InlineKeyboardButton("📱 Copy KPay Number", callback_data="copy_kpay")],
@@ -1809,7 +3075,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
     elif query.data == "copy_kpay":
-        payment_info = get_payment_info()
+        payment_info = await get_payment_info()
         await query.answer(f"📱 KPay Number copied! {payment_info['kpay_number']}", show_alert=True)
         await query.message.reply_text(
             "📱 ***KBZ Pay Number***\n\n"
@@ -1820,7 +3086,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif query.data == "copy_wave":
-        payment_info = get_payment_info()
+        payment_info = await get_payment_info()
         await query.answer(f"📱 Wave Number copied! {payment_info['wave_number']}", show_alert=True)
         await query.message.reply_text(
             "📱 ***Wave Money Number***\n\n"
@@ -1830,47 +3096,241 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
 
-def main():
-    if not BOT_TOKEN:
-        print("❌ BOT_TOKEN environment variable မရှိပါ!")
-        return
+def handler_label(handler, update):
+    """Latency label for a handler; button_callback is split by branch"""
+    if handler is button_callback and update.callback_query:
+        data = update.callback_query.data or ""
+        branch = next((prefix for prefix in CALLBACK_BRANCHES if data.startswith(prefix)), "other")
+        return f"button_callback:{branch.rstrip('_')}"
+    return handler.__name__
+
+def timed(handler):
+    """Wrap a handler callback so its latency lands in handler_latency"""
+    async def timed_handler(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            handler_latency.observe((handler_label(handler, update),), time.perf_counter() - started)
+    return timed_handler
 
-    # Load authorized users on startup
-    load_authorized_users()
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call by method and HTTP status"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            telegram_latency.observe((url.rsplit("/", 1)[-1], str(status)), time.perf_counter() - started)
+
+def render_metrics(application):
+    """Render all metrics and queue gauges as Prometheus text"""
+    gauges = [
+        ("bot_order_queue_depth", "gauge", "Orders waiting for notification workers", order_queue.qsize()),
+        ("bot_update_queue_depth", "gauge", "Updates queued but not yet taken for processing", application.update_queue.qsize()),
+        ("bot_updates_in_flight", "gauge", "Updates taken for processing: waiting on a user lock or handler slot, or running",
+         application.update_queue.in_flight),
+        ("bot_updates_running", "gauge", "Updates whose handlers are running", application.update_processor.running),
+        ("bot_order_queue_max_depth", "gauge", "Highest order queue depth seen", order_pipeline_stats["max_depth"]),
+        ("bot_orders_enqueued_total", "counter", "Orders queued for notification", order_pipeline_stats["enqueued"]),
+        ("bot_orders_processed_total", "counter", "Orders notified by workers", order_pipeline_stats["processed"]),
+        ("bot_orders_failed_total", "counter", "Orders whose notification failed", order_pipeline_stats["failed"]),
+        ("bot_ready", "gauge", "1 once startup has finished", int(bot_ready.is_set()))
+    ]
+    for name, help_text in (
+        ("ready_seconds", "Seconds from process start until the bot was ready"),
+        ("first_update_seconds", "Seconds from process start until the first update arrived")
+    ):
+        if startup_stats[name] is not None:
+            gauges.append((f"bot_{name}", "gauge", help_text, round(startup_stats[name], 3)))
+    parts = [histogram.render() for histogram in (handler_latency, mongo_latency, telegram_latency)]
+    for name, metric_type, help_text, value in gauges:
+        parts.append(f"# HELP {name} {help_text}\n# TYPE {name} {metric_type}\n{name} {value}")
+    return "\n".join(parts) + "\n"
+
+async def serve_metrics(application, reader, writer):
+    """Answer one HTTP request: GET /metrics returns the metrics, /ready 200 or 503, anything else 404"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", render_metrics(application).encode()
+        elif len(parts) > 1 and parts[1] == b"/ready":
+            status, body = ("200 OK", b"ready\n") if bot_ready.is_set() else ("503 Service Unavailable", b"starting\n")
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(application):
+    """Serve /metrics and /ready on METRICS_LISTEN:METRICS_PORT (disabled when METRICS_PORT is 0)"""
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    metrics_server = await asyncio.start_server(partial(serve_metrics, application), METRICS_LISTEN, METRICS_PORT)
+    logger.info("Metrics: http://%s:%s/metrics (readiness: /ready)", METRICS_LISTEN, METRICS_PORT)
+
+async def warm_caches():
+    """Load settings, then authorized users, admins and the compiled price table from it"""
+    started = time.perf_counter()
+    await load_settings()
+    await asyncio.gather(load_authorized_users(), get_admin_ids(), get_compiled_prices())
+    logger.info("Caches warmed in %.2fs", time.perf_counter() - started)
+
+async def build_indexes():
+    """Create indexes off the startup path; they are idempotent and queries work without them"""
+    try:
+        await run_db(ensure_indexes)
+    except Exception:
+        logger.exception("Index creation failed")
+
+def begin_startup(loop):
+    """Schedule the MongoDB warm-up on loop so it overlaps the Bot API getMe in Application.initialize"""
+    startup_tasks["warm_caches"] = loop.create_task(warm_caches())
+    startup_tasks["indexes"] = loop.create_task(build_indexes())
+
+async def mark_ready(application):
+    """Set bot_ready once updates are being fetched (or the webhook is listening) and processed"""
+    while not (application.running and (application.updater is None or application.updater.running)):
+        await asyncio.sleep(0.01)
+    startup_stats["ready_seconds"] = time.monotonic() - PROCESS_STARTED
+    bot_ready.set()
+    logger.info("Bot @%s ready %.2fs after process start", application.bot.username, startup_stats["ready_seconds"])
+
+async def post_init(application: Application):
+    """Finish the cache warm-up, start the order workers and schedule the readiness signal"""
+    await start_metrics_server(application)
+    if "warm_caches" not in startup_tasks:
+        begin_startup(asyncio.get_running_loop())
+    await startup_tasks["warm_caches"]
+    start_order_workers(application.bot)
+    # PTB starts the updater and the application only after post_init returns
+    startup_tasks["ready"] = asyncio.create_task(mark_ready(application))
+
+async def post_stop(application: Application):
+    """Drain the order queue while the bot can still send"""
+    await stop_order_workers()
+
+async def post_shutdown(application: Application):
+    """Stop the metrics endpoint and release the DB executor threads"""
+    for task in startup_tasks.values():
+        task.cancel()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    db_executor.shutdown(wait=False)
+
+def build_application(request=None):
+    """Build the Application with every handler registered; request overrides the Bot API transport"""
+    # Record incoming updates for replay.py, timestamped on arrival so queueing delay isn't baked into the pacing
+    capture_update = None
+    if UPDATE_CAPTURE_PATH:
+        capture_logger = setup_update_capture(UPDATE_CAPTURE_PATH)
+
+        def capture_update(update):
+            capture_logger.info(json.dumps({"t": time.time(), "update": update.to_dict()}, ensure_ascii=False))
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request or InstrumentedRequest())
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # At most UPDATE_QUEUE_SIZE updates in flight and as many queued; a burst beyond that slows intake
+        .update_queue(UpdateIntake(UPDATE_QUEUE_SIZE, UPDATE_QUEUE_SIZE, on_arrival=capture_update))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        # Local Bot API stand-in for load tests (see replay.py)
+        api_url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    application = builder.build()
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Resolve auth, maintenance and session state once per update
+    application.add_handler(TypeHandler(Update, timed(resolve_update_state)), group=-1)
 
     # Command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("mmb", mmb_command))
-    application.add_handler(CommandHandler("balance", balance_command))
-    application.add_handler(CommandHandler("topup", topup_command))
-    application.add_handler(CommandHandler("cancel", cancel_command))
-    application.add_handler(CommandHandler("price", price_command))
-    application.add_handler(CommandHandler("history", history_command))
-    application.add_handler(CommandHandler("approve", approve_command))
-    application.add_handler(CommandHandler("register", register_command))
+    application.add_handler(CommandHandler("start", timed(start)))
+    application.add_handler(CommandHandler("mmb", timed(mmb_command)))
+    application.add_handler(CommandHandler("balance", timed(balance_command)))
+    application.add_handler(CommandHandler("topup", timed(topup_command)))
+    application.add_handler(CommandHandler("cancel", timed(cancel_command)))
+    application.add_handler(CommandHandler("price", timed(price_command)))
+    application.add_handler(CommandHandler("history", timed(history_command)))
+    application.add_handler(CommandHandler("approve", timed(approve_command)))
+    application.add_handler(CommandHandler("confirmorders", timed(confirm_orders_command)))
+    application.add_handler(CommandHandler("cancelorders", timed(cancel_orders_command)))
+    application.add_handler(CommandHandler("approvetopups", timed(approve_topups_command)))
+    application.add_handler(CommandHandler("register", timed(register_command)))
 
     # Callback query handler
-    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(timed(button_callback)))
+
+    # Bot added/promoted/removed in a chat
+    application.add_handler(ChatMemberHandler(timed(track_bot_membership), ChatMemberHandler.MY_CHAT_MEMBER))
 
     # Photo handler (for payment screenshots)
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.PHOTO, timed(handle_photo)))
 
     # Handle all other message types
     application.add_handler(MessageHandler(
         (filters.TEXT | filters.VOICE | filters.Sticker.ALL | filters.VIDEO |
          filters.ANIMATION | filters.AUDIO | filters.Document.ALL |
          filters.FORWARDED | filters.Entity("url") | filters.POLL) & ~filters.COMMAND,
-        handle_restricted_content
+        timed(handle_restricted_content)
     ))
 
-    print("🤖 Bot စတင်နေပါသည် - MongoDB Version")
-    print("✅ MongoDB နဲ့ ချိတ်ဆက်ပြီးပါပြီ")
-    print("🔧 Orders, Topups နဲ့ User Management အဆင်သင့်ပါ")
+    return application
+
+def main():
+    if not BOT_TOKEN:
+        logger.critical("BOT_TOKEN environment variable မရှိပါ!")
+        return
+
+    # Without the secret anyone who finds the URL could post forged updates (e.g. admin callbacks)
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.critical("WEBHOOK_SECRET environment variable မရှိပါ! Webhook mode ကို secret မပါဘဲ မဖွင့်ပါ။")
+        sys.exit(1)
+
+    application = build_application()
+
+    logger.info("Bot စတင်နေပါသည် - MongoDB Version")
+
+    # run_polling/run_webhook pick up this loop, so the warm-up runs while they call getMe
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    begin_startup(loop)
 
     # Run main bot
-    application.run_polling()
+    if WEBHOOK_URL:
+        logger.info("Webhook mode: listening on %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-    main()
+    setup_logging()
+    if sys.argv[1:] == ["migrate"]:
+        migrate_embedded_history()
+        backfill_pending_topup_counters()
+    else:
+        main()
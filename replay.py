@@ -0,0 +1,303 @@
+"""Update replay against a local Bot API stand-in
+
+Capture real traffic by running the bot with UPDATE_CAPTURE_PATH=updates.jsonl, then replay it:
+
+    python replay.py updates.jsonl --speed 10 --latency-ms 40 --rate-429 0.02 --spawn
+
+The stand-in serves the Bot API methods the bot uses (answers come from fake_api_result) and
+feeds the captured updates to getUpdates at --speed times their recorded pace. Latency is
+added to every other method, and 429 Too Many Requests responses are injected into all of
+them except the bootstrap ones (getMe, deleteWebhook, setWebhook, getWebhookInfo). --spawn starts
+`python main.py` against it (TELEGRAM_API_URL), waits until the replay has gone quiet and
+prints call counts and reply latency. Without --spawn, point a bot at the printed URL
+yourself and stop the stand-in with Ctrl-C. Use a scratch MONGO_URI: the replayed
+orders and topups are real writes.
+
+--webhook exercises webhook mode instead: the spawned bot runs run_webhook on
+--webhook-port and the captured updates are POSTed to it with the secret token header.
+A wrong and a missing secret are tried first and must be refused with 403; the exit
+status is 1 if they aren't.
+"""
+import argparse, asyncio, itertools, json, logging, os, random, subprocess, sys, time
+from collections import deque
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+
+BOT_ID = 999
+WEBHOOK_SECRET = "replay-secret"
+# Called once by PTB's bootstrap, which doesn't retry, so a 429 there would kill the bot
+BOOTSTRAP_METHODS = ("getMe", "deleteWebhook", "setWebhook", "getWebhookInfo")
+REPLY_METHODS = ("sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "editMessageReplyMarkup")
+
+message_ids = itertools.count(1)
+
+def fake_message(chat_id, text=None, **extra):
+    """Bot API Message object for a sent message"""
+    return {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+        **({"text": text} if text is not None else {}),
+        **extra
+    }
+
+def fake_api_result(method, params):
+    """Result the fake Bot API returns for a method (only the shape the bot relies on)"""
+    if method == "getMe":
+        return {
+            "id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False
+        }
+    if method in REPLY_METHODS and method != "sendPhoto":
+        return fake_message(int(params.get("chat_id", 1)), params.get("text"))
+    if method == "sendPhoto":
+        photo = [{"file_id": "bench", "file_unique_id": "bench", "width": 1, "height": 1}]
+        return fake_message(int(params.get("chat_id", 1)), photo=photo)
+    if method == "getChatMember":
+        return {"status": "member", "user": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"}}
+    if method == "getUserProfilePhotos":
+        return {"total_count": 0, "photos": []}
+    return True
+
+def update_chat_id(update):
+    """Chat the bot is expected to answer an update in"""
+    if "callback_query" in update:
+        message = update["callback_query"].get("message")
+        return message["chat"]["id"] if message else update["callback_query"]["from"]["id"]
+    for key in ("message", "edited_message", "my_chat_member"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    return None
+
+def load_capture(path):
+    """Read a capture file into (offset seconds, update) pairs"""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entries.append((entry["t"], entry["update"]))
+    if not entries:
+        return []
+    start = entries[0][0]
+    return [(t - start, update) for t, update in entries]
+
+class BotApiStandIn:
+    """Bot API stand-in: serves getUpdates from a capture, fakes every other method"""
+
+    def __init__(self, entries, speed, latency_ms, jitter_ms, rate_429, retry_after, webhook_url=None):
+        self.entries = entries
+        self.speed = speed
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.updates = deque()
+        self.new_updates = asyncio.Condition()
+        self.awaiting_reply = {}
+        self.calls = {}
+        self.throttled = 0
+        self.reply_latencies = []
+        self.delivered = 0
+        self.fed = False
+        self.last_call = time.monotonic()
+        self.webhook_url = webhook_url
+        self.webhook_checks = {}
+        self.webhook_set = asyncio.Event()
+
+    async def feed(self):
+        """Release captured updates at their recorded pace divided by speed"""
+        started = time.monotonic()
+        for update_id, (offset, update) in enumerate(self.entries, start=1):
+            if self.speed:
+                delay = started + offset / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update = {**update, "update_id": update_id}
+            await self.deliver(update)
+            chat_id = update_chat_id(update)
+            if chat_id is not None:
+                self.awaiting_reply.setdefault(chat_id, deque()).append(time.monotonic())
+        self.fed = True
+
+    async def deliver(self, update):
+        """Queue an update for getUpdates, or POST it to the bot's webhook"""
+        if self.webhook_url is None:
+            async with self.new_updates:
+                self.updates.append(update)
+                self.new_updates.notify_all()
+            return
+        status = await self.post_update(update, WEBHOOK_SECRET)
+        if status == 200:
+            self.delivered = max(self.delivered, update["update_id"])
+        else:
+            print(f"Webhook refused update {update['update_id']} with {status}")
+
+    async def post_update(self, update, secret):
+        """POST an update to the bot's webhook; returns the HTTP status"""
+        headers = {"Content-Type": "application/json"}
+        if secret is not None:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        response = await AsyncHTTPClient().fetch(
+            self.webhook_url, method="POST", body=json.dumps(update), headers=headers, raise_error=False
+        )
+        return response.code
+
+    async def check_webhook_secret(self):
+        """Post an empty update with a wrong and with no secret; both must get 403"""
+        for label, secret in (("wrong secret", WEBHOOK_SECRET + "-forged"), ("no secret", None)):
+            self.webhook_checks[label] = await self.post_update({"update_id": 0}, secret)
+        return all(status == 403 for status in self.webhook_checks.values())
+
+    async def get_updates(self, params):
+        """Long-poll for updates at or after offset"""
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        async with self.new_updates:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            batch = list(itertools.islice(self.updates, limit))
+        self.delivered = max(self.delivered, batch[-1]["update_id"] if batch else 0)
+        return batch
+
+    async def respond(self, method, params):
+        """(HTTP status, Bot API response) for one call"""
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.last_call = time.monotonic()
+        if method == "setWebhook":
+            # PTB sets the webhook once its listener is up
+            self.webhook_set.set()
+        if self.latency_ms:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+        if method not in BOOTSTRAP_METHODS and random.random() < self.rate_429:
+            self.throttled += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }
+
+        if method in REPLY_METHODS:
+            waiting = self.awaiting_reply.get(int(params.get("chat_id", 0)))
+            if waiting:
+                self.reply_latencies.append(time.monotonic() - waiting.popleft())
+        return 200, {"ok": True, "result": fake_api_result(method, params)}
+
+    def summary(self):
+        """Printable replay results"""
+        lines = [f"Updates delivered: {self.delivered}/{len(self.entries)}", f"429s injected: {self.throttled}"]
+        for label, status in self.webhook_checks.items():
+            lines.append(f"Webhook update with {label}: HTTP {status} ({'ok' if status == 403 else 'FAIL, expected 403'})")
+        if self.reply_latencies:
+            ordered = sorted(self.reply_latencies)
+            p50 = ordered[len(ordered) // 2] * 1000
+            p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1000
+            lines.append(f"Reply latency: p50 {p50:.1f} ms, p99 {p99:.1f} ms ({len(ordered)} replies)")
+        for method, count in sorted(self.calls.items(), key=lambda item: -item[1]):
+            lines.append(f"  {method:<28}{count:>8}")
+        return "\n".join(lines)
+
+class BotApiHandler(tornado.web.RequestHandler):
+    """POST/GET /bot<token>/<method>"""
+
+    def initialize(self, stand_in):
+        self.stand_in = stand_in
+
+    async def post(self, method):
+        params = {name: self.get_argument(name, strip=False) for name in self.request.arguments}
+        status, payload = await self.stand_in.respond(method, params)
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload))
+
+    get = post
+
+async def wait_until_quiet(stand_in, idle):
+    """Return once every update has been fetched and no call has come in for idle seconds"""
+    while not (stand_in.fed and stand_in.delivered == len(stand_in.entries)
+               and time.monotonic() - stand_in.last_call > idle):
+        await asyncio.sleep(0.2)
+
+async def run(args):
+    """Serve the stand-in, feed the capture and optionally run the bot against it"""
+    webhook_url = f"http://127.0.0.1:{args.webhook_port}/webhook" if args.webhook else None
+    stand_in = BotApiStandIn(
+        load_capture(args.capture), args.speed, args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after,
+        webhook_url
+    )
+    # Injected 429s would otherwise flood the console through tornado's access log
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    app = tornado.web.Application([(r"/bot[^/]+/(\w+)", BotApiHandler, {"stand_in": stand_in})])
+    server = app.listen(args.port, address="127.0.0.1")
+    api_url = f"http://127.0.0.1:{args.port}"
+    print(f"Bot API stand-in on {api_url} replaying {len(stand_in.entries)} updates at {args.speed or 'max'}x")
+    webhook_env = {
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.webhook_port}", "WEBHOOK_PATH": "webhook",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET, "WEBHOOK_LISTEN": "127.0.0.1", "WEBHOOK_PORT": str(args.webhook_port)
+    }
+    if args.webhook and not args.spawn:
+        print("Run the bot with " + " ".join(f"{name}={value}" for name, value in webhook_env.items()))
+
+    bot = None
+    if args.spawn:
+        env = {**os.environ, "TELEGRAM_API_URL": api_url, "METRICS_PORT": os.environ.get("METRICS_PORT", "0")}
+        env.pop("WEBHOOK_URL", None)
+        if args.webhook:
+            env.update(webhook_env)
+        bot = subprocess.Popen([sys.executable, "main.py"], env=env)
+
+    secret_checked = True
+    if args.webhook:
+        await stand_in.webhook_set.wait()
+        secret_checked = await stand_in.check_webhook_secret()
+
+    started = time.monotonic()
+    feeder = asyncio.create_task(stand_in.feed())
+    try:
+        if bot:
+            await wait_until_quiet(stand_in, args.idle)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        feeder.cancel()
+        if bot:
+            bot.terminate()
+            bot.wait()
+        server.stop()
+        elapsed = time.monotonic() - started
+        print(f"Replay took {elapsed:.1f}s ({stand_in.delivered / elapsed:.1f} updates/s)")
+        print(stand_in.summary())
+    return secret_checked
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured updates against a local Bot API stand-in")
+    parser.add_argument("capture", help="JSONL written by the bot with UPDATE_CAPTURE_PATH")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay pace multiplier, 0 for as fast as possible")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency per Bot API call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="standard deviation of the added latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds sent with each 429")
+    parser.add_argument("--spawn", action="store_true", help="run main.py against the stand-in and stop when done")
+    parser.add_argument("--idle", type=float, default=3.0, help="quiet seconds that end a --spawn replay")
+    parser.add_argument("--webhook", action="store_true", help="POST the updates to the bot's run_webhook listener")
+    parser.add_argument("--webhook-port", type=int, default=8444, help="port the bot's webhook listener uses")
+    args = parser.parse_args()
+    try:
+        if not asyncio.run(run(args)):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()